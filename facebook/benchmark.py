@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Facebook archive builder against synthetic exports
+Generates exports in the layout build_archive.py expects and records
+per-phase timings and peak RSS as scaling curves in JSON
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+EXPORT_ROOT = "this_profile's_activity_across_facebook"
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+POSTS_PER_SHARD = 10000
+PHOTOS_PER_ALBUM = 20
+# Albums the builder looks for by name, plus generic ones
+ALBUM_NAMES = ("Profile pictures", "Cover photos", "Mobile uploads", "Timeline photos")
+START_TIMESTAMP = 1262304000  # 2010-01-01
+# Phases slower than this ratio against a baseline run are reported as regressions
+REGRESSION_THRESHOLD = 1.2
+
+WORDS = (
+    "podcast episode tech news android iphone apple google microsoft windows linux "
+    "review listener question show notes download stream live tonight guest interview "
+    "gadget phone tablet laptop update release beta security privacy cloud app"
+).split()
+# Non-ASCII text that Facebook exports as latin-1 mojibake
+ACCENTED = ("café", "naïve", "résumé", "piñata", "Zoë", "über", "jalapeño", "—", "“quoted”", "🎙️", "👍")
+
+def mojibake(text):
+    """Encode text the way the Facebook export does: UTF-8 bytes read as latin-1"""
+    return text.encode('utf-8').decode('latin-1')
+
+def make_png(index, width=8, height=8):
+    """A tiny valid PNG whose solid colour is unique to index, so no two files share bytes"""
+    color = struct.pack('>I', index & 0xFFFFFF)[1:]
+    raw = (b'\x00' + color * width) * height
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw))
+            + chunk(b'IEND', b''))
+
+def random_text(rng, words):
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    if rng.random() < 0.3:
+        text += " " + rng.choice(ACCENTED)
+    if rng.random() < 0.2:
+        text += f" https://example.com/{rng.randrange(10 ** 6)}"
+    return text
+
+def generate_export(root, posts, albums=None, media_files=None, seed=0):
+    """Write a synthetic export under root and return its counts.
+
+    Posts are split into profile_posts_N.json shards of POSTS_PER_SHARD,
+    spread one to a few days apart going back from the newest. Media files
+    are tiny PNGs shared round-robin between posts and albums.
+    """
+    rng = random.Random(seed)
+    if albums is None:
+        albums = max(len(ALBUM_NAMES), posts // 1000)
+    if media_files is None:
+        media_files = max(10, posts // 10)
+
+    posts_dir = Path(root) / "archive" / EXPORT_ROOT / "posts"
+    if posts_dir.exists():
+        shutil.rmtree(posts_dir)
+    album_dir = posts_dir / "album"
+    album_dir.mkdir(parents=True)
+
+    folders = [f"Album{i}_{1000 + i}" for i in range(albums)]
+    media = []
+    for i in range(media_files):
+        folder = folders[i % len(folders)]
+        (posts_dir / "media" / folder).mkdir(parents=True, exist_ok=True)
+        name = f"{10 ** 14 + i}.png"
+        (posts_dir / "media" / folder / name).write_bytes(make_png(i))
+        media.append(f"{EXPORT_ROOT}/posts/media/{folder}/{name}")
+
+    timestamps = []
+    ts = START_TIMESTAMP + posts * 86400
+    for _ in range(posts):
+        ts -= rng.randint(600, 3 * 86400)
+        timestamps.append(ts)
+
+    shards = 0
+    for start in range(0, posts, POSTS_PER_SHARD):
+        shards += 1
+        items = []
+        for i in range(start, min(start + POSTS_PER_SHARD, posts)):
+            item = {
+                'timestamp': timestamps[i],
+                'title': mojibake("Deemable Tech updated their status."),
+                'data': [{'post': mojibake(random_text(rng, rng.randint(5, 60)))}],
+            }
+            attachments = []
+            if rng.random() < 0.4:
+                attachments.append({'data': [{'media': {
+                    'uri': media[rng.randrange(media_files)],
+                    'description': mojibake(random_text(rng, 8)),
+                }} for _ in range(rng.choice((1, 1, 1, 2, 4)))]})
+            if rng.random() < 0.15:
+                attachments.append({'data': [{'external_context': {
+                    'url': f"https://example.com/article/{rng.randrange(10 ** 6)}"}}]})
+            if attachments:
+                item['attachments'] = attachments
+            items.append(item)
+        with open(posts_dir / f"profile_posts_{shards}.json", 'w', encoding='utf-8') as f:
+            json.dump(items, f)
+
+    for i in range(albums):
+        photos = [{
+            'uri': media[(i + j * albums) % media_files],
+            'creation_timestamp': START_TIMESTAMP + rng.randrange(posts * 86400 or 1),
+            'description': mojibake(random_text(rng, 6)),
+        } for j in range(PHOTOS_PER_ALBUM)]
+        name = ALBUM_NAMES[i] if i < len(ALBUM_NAMES) else f"Album {i}"
+        with open(album_dir / f"{i}.json", 'w', encoding='utf-8') as f:
+            json.dump({'name': mojibake(name), 'description': mojibake(random_text(rng, 10)),
+                       'photos': photos, 'cover_photo': photos[0]}, f)
+
+    return {'posts': posts, 'albums': albums, 'media_files': media_files, 'shards': shards}
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    """Peak resident set size so far, in KB.
+
+    With RUSAGE_CHILDREN this is the largest finished worker process.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def measure_build(root, workers, link_mode, layout, per_page):
+    """Time each builder phase against the export in root (runs in a fresh process)"""
+    os.chdir(root)
+    sys.path.insert(0, str(SCRIPT_DIR))
+    import build_archive as ba
+
+    phases = {}
+
+    def timed(name, func, *args):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args)
+        phases[name] = {
+            'seconds': round(time.perf_counter() - wall, 4),
+            'cpu_seconds': round(time.process_time() - cpu, 4),
+            'peak_rss_kb': peak_rss_kb(),
+            'worker_peak_rss_kb': peak_rss_kb(resource.RUSAGE_CHILDREN),
+        }
+        return result
+
+    def render_all(func, calls):
+        return sum(len(func(*args)) for args in calls)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        posts = timed('load_posts', ba.load_posts, workers)
+        albums = timed('load_albums', ba.load_albums, workers)
+        timed('copy_media_files', ba.copy_media_files, None, workers, link_mode, layout)
+
+        profile_pic = ba.get_media_path(albums[0]['photos'][0]['uri']) if albums else None
+        cover_photo = ba.get_media_path(albums[1]['photos'][0]['uri']) if len(albums) > 1 else None
+        pages = ba.paginate(posts, per_page)
+        years = ba.group_posts_by_month(posts)
+        archive_calls = []
+        for year, months in years.items():
+            for month, month_posts in months.items():
+                month_pages = ba.paginate(month_posts, per_page)
+                archive_calls += [(page_posts, ba.month_name(year, month), f"month-{year}-{month:02d}",
+                                   page, len(month_pages), profile_pic)
+                                  for page, page_posts in enumerate(month_pages, 1)]
+
+        page_bytes = {
+            'generate_css': timed('generate_css', render_all, ba.generate_css, [()]),
+            'generate_index_page': timed('generate_index_page', render_all, ba.generate_index_page, [
+                (page_posts, albums, profile_pic, cover_photo, page, len(pages))
+                for page, page_posts in enumerate(pages, 1)]),
+            'generate_archive_page': timed('generate_archive_page', render_all, ba.generate_archive_page,
+                                           archive_calls),
+            'generate_archives_page': timed('generate_archives_page', render_all, ba.generate_archives_page,
+                                            [(years,)]),
+            'generate_post_page': timed('generate_post_page', render_all, ba.generate_post_page, [
+                (post, profile_pic, None, None) for post in posts]),
+            'generate_photos_page': timed('generate_photos_page', render_all, ba.generate_photos_page,
+                                          [(albums, profile_pic)]),
+            'generate_album_page': timed('generate_album_page', render_all, ba.generate_album_page,
+                                         [(album, i, profile_pic, page) for i, album in enumerate(albums)
+                                          for page in range(1, len(ba.paginate(ba.album_photos(album),
+                                                                               ba.ALBUM_PHOTOS_PER_PAGE)) + 1)]),
+            'generate_search_page': timed('generate_search_page', render_all, ba.generate_search_page, [()]),
+            'generate_about_page': timed('generate_about_page', render_all, ba.generate_about_page,
+                                         [(profile_pic,)]),
+        }
+
+    for name, size in page_bytes.items():
+        phases[name]['output_bytes'] = size
+    return {'phases': phases, 'peak_rss_kb': peak_rss_kb()}
+
+def run_in_fresh_process(func, *args):
+    """Run func in a newly spawned process, so peak RSS covers that call alone"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(func, *args).result()
+
+def run_benchmark(sizes, workers, link_mode, layout, per_page, workdir=None, keep=False):
+    """Generate and measure an export for each size, smallest first"""
+    runs = []
+    for size in sorted(sizes):
+        root = Path(tempfile.mkdtemp(prefix=f"fb-bench-{size}-", dir=workdir))
+        try:
+            start = time.perf_counter()
+            counts = run_in_fresh_process(generate_export, root, size)
+            print(f"{size:>9,} posts: generated {counts['shards']} shards, {counts['albums']} albums, "
+                  f"{counts['media_files']} media files in {time.perf_counter() - start:.1f}s")
+            result = run_in_fresh_process(measure_build, root, workers, link_mode, layout, per_page)
+        finally:
+            if not keep:
+                shutil.rmtree(root, ignore_errors=True)
+        total = sum(phase['seconds'] for phase in result['phases'].values())
+        print(f"{'':>9}  measured {total:.2f}s, peak RSS {result['peak_rss_kb'] / 1024:.0f} MB")
+        runs.append({**counts, **result})
+    return runs
+
+def scaling_curves(runs):
+    """Per-phase [posts, seconds] and [posts, peak RSS] series across runs"""
+    curves = {}
+    for run in runs:
+        for name, phase in run['phases'].items():
+            curve = curves.setdefault(name, {'seconds': [], 'peak_rss_kb': []})
+            curve['seconds'].append([run['posts'], phase['seconds']])
+            curve['peak_rss_kb'].append([run['posts'], phase['peak_rss_kb']])
+    return curves
+
+def compare_reports(baseline, report, threshold=REGRESSION_THRESHOLD):
+    """Print phase timings against a baseline report; returns the number of regressions"""
+    old_runs = {run['posts']: run for run in baseline['runs']}
+    regressions = 0
+    for run in report['runs']:
+        old = old_runs.get(run['posts'])
+        if not old:
+            continue
+        print(f"\n{run['posts']:,} posts (baseline -> now):")
+        for name, phase in run['phases'].items():
+            if name not in old['phases']:
+                continue
+            before, after = old['phases'][name]['seconds'], phase['seconds']
+            ratio = after / before if before else 1.0
+            flag = ""
+            # Sub-10ms phases are too noisy to call regressions
+            if ratio > threshold and after - before > 0.01:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {name:<24} {before:>9.3f}s -> {after:>9.3f}s  x{ratio:.2f}{flag}")
+        before, after = old['peak_rss_kb'], run['peak_rss_kb']
+        print(f"  {'peak RSS':<24} {before / 1024:>8.0f}MB -> {after / 1024:>8.0f}MB")
+    return regressions
+
+def parse_sizes(value):
+    sizes = []
+    for part in value.split(','):
+        part = part.strip().lower()
+        scale = 1
+        if part.endswith('k'):
+            part, scale = part[:-1], 1000
+        elif part.endswith('m'):
+            part, scale = part[:-1], 1000000
+        sizes.append(int(float(part) * scale))
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark build_archive.py on synthetic exports")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="write a synthetic export to a directory")
+    generate.add_argument('root', type=Path, help="directory to write archive/ into")
+    generate.add_argument('--posts', type=int, default=1000)
+    generate.add_argument('--albums', type=int, help="default: one per 1000 posts, at least 4")
+    generate.add_argument('--media-files', type=int, help="default: one per 10 posts, at least 10")
+    generate.add_argument('--seed', type=int, default=0)
+
+    run = commands.add_parser('run', help="measure builder phases across export sizes")
+    run.add_argument('--sizes', type=parse_sizes, default=list(DEFAULT_SIZES),
+                     help="comma-separated post counts, e.g. 1k,10k,100k (default: 1k,10k,100k,1m)")
+    run.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                     help="workers passed to the builder (default: CPU count)")
+    run.add_argument('--link-mode', choices=('auto', 'reflink', 'hardlink', 'copy'), default='auto')
+    run.add_argument('--media-layout', choices=('flat', 'hashed'), default='flat')
+    run.add_argument('--posts-per-page', type=int, default=25)
+    run.add_argument('--workdir', type=Path, help="where to create the exports (default: system temp)")
+    run.add_argument('--keep', action='store_true', help="keep the generated exports")
+    run.add_argument('--output', type=Path, default=Path("benchmark.json"),
+                     help="where to write the JSON report (default: benchmark.json)")
+    run.add_argument('--compare', type=Path, metavar='REPORT',
+                     help="compare timings against an earlier report")
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        counts = generate_export(args.root, args.posts, args.albums, args.media_files, args.seed)
+        print(f"Wrote {counts['posts']} posts in {counts['shards']} shards, {counts['albums']} albums "
+              f"and {counts['media_files']} media files to {args.root / 'archive'}")
+        return 0
+
+    sys.path.insert(0, str(SCRIPT_DIR))
+    import build_archive
+    runs = run_benchmark(args.sizes, args.jobs, args.link_mode, args.media_layout,
+                         args.posts_per_page, args.workdir, args.keep)
+    report = {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'builder_version': build_archive.BUILDER_VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'jobs': args.jobs,
+            'link_mode': args.link_mode,
+            'media_layout': args.media_layout,
+            'posts_per_page': args.posts_per_page,
+        },
+        'runs': runs,
+        'curves': scaling_curves(runs),
+    }
+    args.output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+    print(f"\nWrote {args.output}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding='utf-8'))
+        return 1 if compare_reports(baseline, report) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,18 +4,197 @@ Build static Facebook archive for Deemable Tech
 Converts Facebook data export to a static HTML site
 """
 
+import argparse
+import asyncio
+import cProfile
+import gzip
+import hashlib
+import heapq
+import io
 import json
+import marshal
+import mmap
 import os
+import pstats
 import shutil
-from datetime import datetime
+import subprocess
+import time
+import threading
+import tracemalloc
+import traceback
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
 import html
 import re
+import struct
+import sys
+from array import array
+import unicodedata
+import urllib.request
+from html.parser import HTMLParser
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlsplit
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS in the build report
+    resource = None
+
+try:
+    import brotli
+except ImportError:  # Only .gz siblings are written without brotli
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # Thumbnails are skipped without Pillow
+    Image = None
 
 # Paths
+SITE_URL = "https://deemable.rayhollister.com"
+ARCHIVE_URL = f"{SITE_URL}/facebook/"
 ARCHIVE_DIR = Path("archive/this_profile's_activity_across_facebook")
 OUTPUT_DIR = Path(".")
 MEDIA_OUTPUT = OUTPUT_DIR / "media"
+THUMBS_OUTPUT = MEDIA_OUTPUT / "thumbs"
+MANIFEST_FILE = OUTPUT_DIR / ".build-manifest.json"
+STAGING_DIR = OUTPUT_DIR / ".staging"
+LOCK_FILE = OUTPUT_DIR / ".build-lock"
+PRECOMPRESS_MANIFEST = ".precompress-manifest.json"
+OPTIMIZE_MANIFEST = ".optimize-manifest.json"
+PREVIEWS_FILE = OUTPUT_DIR / "link_previews.json"
+SNAPSHOT_FILE = OUTPUT_DIR / ".export-snapshot"
+REPORT_FILE = OUTPUT_DIR / "build-report.json"
+PROFILE_FILE = OUTPUT_DIR / "build-profile.prof"
+WRITE_BUFFER_SIZE = 256 * 1024
+# Fewer changed pages than this render inline; a pool costs more to start than it saves
+RENDER_POOL_MIN_PAGES = 8
+
+# Bump when the output format changes in a way the source hash can't see
+BUILDER_VERSION = 2
+# Bump when parse_post()/load_album_file() change what they produce
+SNAPSHOT_VERSION = 1
+REPORT_VERSION = 1
+PROFILE_TOP = 30  # hot functions and allocation sites kept in the report
+PROFILE_FRAMES = 8  # tracemalloc traceback depth
+WATCH_INTERVAL = 0.2  # seconds between polls of the export
+WATCH_SETTLE = 0.05  # wait for editors that save in several writes
+LIVE_RELOAD_PATH = "/__livereload"
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.mp4', '.webp')
+POSTS_PER_PAGE = 25
+POST_SLUG_HASH_LENGTH = 8
+SITEMAP_MAX_URLS = 50000
+SITEMAP_MAX_BYTES = 50 * 1000 * 1000  # uncompressed, per the sitemap protocol
+# Parts of the site root that aren't WordPress mirror pages
+SITEMAP_SKIP_DIRS = {'wp-content', 'wp-includes', 'feed', "this_profile's_activity_across_facebook"}
+ZIP_COPY_CHUNK = 1024 * 1024
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+HASHED_NAME_LENGTH = 16
+PRECOMPRESS_EXTENSIONS = ('.html', '.css', '.js', '.json', '.xml', '.svg')
+PRECOMPRESS_MIN_SIZE = 256
+OPTIMIZE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# PNG chunks that affect how the image is displayed; every other ancillary chunk is dropped
+PNG_KEEP_CHUNKS = {b'IHDR', b'PLTE', b'IDAT', b'IEND', b'tRNS', b'gAMA', b'cHRM', b'sRGB', b'iCCP', b'sBIT',
+                   b'acTL', b'fcTL', b'fdAT'}
+PREVIEW_TTL = 30 * 24 * 3600
+PREVIEW_ERROR_TTL = 24 * 3600
+PREVIEW_TIMEOUT = 10
+PREVIEW_MAX_CONNECTIONS = 16
+PREVIEW_MAX_PER_HOST = 2
+PREVIEW_MAX_PAGE_BYTES = 512 * 1024
+PREVIEW_MAX_IMAGE_BYTES = 10 * 1024 * 1024
+PREVIEW_IMAGE_WIDTH = 800
+PREVIEW_USER_AGENT = "Mozilla/5.0 (compatible; DeemableArchiveBot/1.0; +https://deemable.rayhollister.com/)"
+SEARCH_DIR = "search"
+SERVICE_WORKER = "sw.js"
+PRECACHE_MANIFEST = "precache-manifest.json"
+PRECACHE_CONCURRENCY = 6  # requests the service worker keeps in flight while precaching
+RUNTIME_CACHE_ENTRIES = 500  # media and JSON kept beyond the precache, oldest evicted first
+# URL paths the service worker serves cache-first: thumbnails and the stylesheet are named by
+# content hash, and so is all of media/ under --media-layout hashed
+SERVICE_WORKER_IMMUTABLE = {
+    'flat': r'\/(media\/thumbs\/|style\.[0-9a-f]+\.css$)',
+    'hashed': r'\/(media\/|style\.[0-9a-f]+\.css$)',
+}
+ALBUMS_DIR = "albums"
+ALBUM_PHOTOS_PER_PAGE = 60
+LIGHTBOX_PREFETCH = 2  # photos preloaded on each side of the one in the lightbox
+SEARCH_SHARD_BYTES = 16 * 1024
+SEARCH_DOCS_PER_CHUNK = 50
+SEARCH_SNIPPET_LENGTH = 160
+# Bump when tokenize() changes, so browsers refetch the index instead of reusing old shards
+SEARCH_INDEX_VERSION = 2
+# Accented, compatibility and non-Latin text that both tokenizers must split the same way
+SEARCH_TOKENIZER_SAMPLES = (
+    "Résumé café naïve jalapeño über",
+    "Ångström Øresund façade smörgåsbord Crème brûlée",
+    "İSTANBUL şehir ğüşöç ŁÓDŹ",
+    "Tiếng Việt có dấu, Ελληνικά άλφα, Привет ёжик",
+    "ﬁnancial ½ x² ① ｆｕｌｌｗｉｄｔｈ",
+    "日本語のテキスト かな 한국어",
+    "١٢٣ 2024 v2 42nd snake_case o'neil",
+)
+SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be but by com for from has have http https in is it its of on or "
+    "that the this to was were will with www you your".split()
+)
+THUMB_WIDTHS = (320, 640, 960)
+VIDEO_EXTENSIONS = ('.mp4',)
+VIDEO_COPY_CHUNK = 8 * 1024 * 1024
+# Boxes on the path from moov down to the chunk offset tables
+MP4_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf'}
+THUMB_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+DHASH_SIZE = 8  # difference hash of an 8x8 grid: 64 bits
+# Hashes at most this many bits apart are candidates for being the same photo...
+DEDUPE_DISTANCE = 4
+# ...confirmed when aspect ratios agree and no cell of a 16x16 grayscale copy differs by more than this
+DEDUPE_ASPECT_TOLERANCE = 0.02
+DEDUPE_GRID = 16
+DEDUPE_MAX_CELL_DIFF = 32
+
+# <img sizes> for each place the builder shows an image, matching the CSS
+SIZES_POST_MEDIA = "(max-width: 680px) 100vw, 648px"
+SIZES_COVER_PHOTO = "(max-width: 680px) 100vw, 648px"
+SIZES_PROFILE_PIC = "168px"
+SIZES_AVATAR = "40px"
+SIZES_ALBUM_COVER = "(max-width: 600px) 50vw, 210px"
+SIZES_PHOTO_TILE = "(max-width: 600px) 100vw, 325px"
+
+# Export ZIP parts read instead of ARCHIVE_DIR (--export-zip), and their member index
+EXPORT_ZIPS = []
+EXPORT_INDEX = {}
+
+# Media key (path under posts/media) -> output filename, filled by copy_media_files()
+MEDIA_INDEX = {}
+# Bare filename -> output filename, for paths that only know the basename
+MEDIA_NAMES = {}
+# Output filename -> {'width', 'height', 'widths', 'webp', 'hash'}, filled by generate_thumbnails()
+THUMBNAILS = {}
+# Output filename -> (width, height) as displayed, filled by index_image_dimensions()
+DIMENSIONS = {}
+# Output filename -> {'duration', 'width', 'height'}, filled by prepare_videos()
+VIDEOS = {}
+# External URL -> {'title', 'description', 'site_name', 'local_image', ...}, filled by resolve_link_previews()
+LINK_PREVIEWS = {}
+# Stylesheet filename and optional inlined critical CSS, filled by write_stylesheet()
+STYLESHEET = {'href': None, 'critical': None}
+
+# Rules needed to paint the header, nav and first posts/tiles before style.css arrives
+CRITICAL_SELECTORS = (
+    ':root', '*', 'body', '.archive-banner', 'header', '.header-content', 'nav', 'main',
+    '.cover-section', '.cover-photo', '.profile-', '.post', '.album-header', '.albums-grid',
+    '.album-card', '.album-cover', '.photos-grid', '.photo-item',
+)
 
 def decode_facebook_text(text):
     """Facebook exports text in latin-1 encoded as UTF-8, decode it properly"""
@@ -56,106 +235,2653 @@ def load_json(filepath):
         print(f"Error loading {filepath}: {e}")
         return None
 
+def hash_bytes(data):
+    """Return a hex SHA-256 digest of bytes or str"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    """Return a hex SHA-256 digest of a file's contents"""
+    digest = hashlib.sha256()
+    with (filepath.open() if isinstance(filepath, ZipMember) else open(filepath, 'rb')) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_inputs(*inputs):
+    """Hash JSON-serializable page inputs into a stable key"""
+    return hash_bytes(json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str))
+
+def builder_fingerprint():
+    """Hash of everything shared by all pages: script source, templates and CSS"""
+    try:
+        source = Path(__file__).read_bytes()
+    except OSError:
+        source = b''
+    return hash_inputs(BUILDER_VERSION, hash_bytes(source), hash_bytes(generate_css()))
+
+def empty_manifest():
+    """A build manifest with no recorded outputs"""
+    return {'version': BUILDER_VERSION, 'pages': {}, 'media': {}, 'thumbs': {}, 'dimensions': {}, 'videos': {},
+            'fingerprints': {}}
+
+def load_manifest():
+    """Load the build manifest from the previous run"""
+    if not MANIFEST_FILE.exists():
+        return empty_manifest()
+    manifest = load_json(MANIFEST_FILE)
+    if not manifest or manifest.get('version') != BUILDER_VERSION:
+        return empty_manifest()
+    for section, value in empty_manifest().items():
+        manifest.setdefault(section, value)
+    return manifest
+
+def save_manifest(manifest):
+    """Atomically write the build manifest"""
+    tmp = MANIFEST_FILE.with_name(MANIFEST_FILE.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST_FILE)
+
+def _cpu_time():
+    """CPU seconds used by this process and every worker it has reaped"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def peak_rss_kb():
+    """Peak resident set size of the builder and of its largest worker, in KB"""
+    if resource is None:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1  # macOS reports bytes
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+
+class BuildReport:
+    """Wall and CPU time per build phase plus named counters.
+
+    A phase can be entered more than once and accumulates. CPU time
+    includes worker processes that exit during the phase, so stages that
+    fan out to a pool report their whole cost, not just the parent's.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        wall, cpu = time.perf_counter(), _cpu_time()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            entry['wall_seconds'] += time.perf_counter() - wall
+            entry['cpu_seconds'] += _cpu_time() - cpu
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        return {
+            'version': REPORT_VERSION,
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'wall_seconds': round(time.time() - self.started, 3),
+            'peak_rss_kb': peak_rss_kb(),
+            'phases': {name: {k: round(v, 3) for k, v in entry.items()} for name, entry in self.phases.items()},
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def print_summary(self):
+        for name, entry in self.phases.items():
+            print(f"  {name:<12} {entry['wall_seconds']:8.2f}s wall {entry['cpu_seconds']:8.2f}s cpu")
+
+# Filled in by main(); module level so every stage can count into it
+REPORT = BuildReport()
+
+def start_profiling():
+    """Start cProfile and tracemalloc for --profile"""
+    tracemalloc.start(PROFILE_FRAMES)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profiling(profiler):
+    """Stop profiling, dump the raw stats to PROFILE_FILE and summarize the hot spots.
+
+    Only the main process is profiled; work done in pool workers shows up
+    as time spent waiting on futures.
+    """
+    profiler.disable()
+    profiler.dump_stats(PROFILE_FILE)
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    functions = [
+        {'function': f"{Path(file).name}:{line}({name})", 'calls': calls,
+         'own_seconds': round(own, 4), 'cumulative_seconds': round(cumulative, 4)}
+        for (file, line, name), (_, calls, own, cumulative, _) in pstats.Stats(profiler).stats.items()
+    ]
+    functions.sort(key=lambda f: f['own_seconds'], reverse=True)
+    allocations = [
+        {'line': f"{Path(stat.traceback[0].filename).name}:{stat.traceback[0].lineno}",
+         'bytes': stat.size, 'blocks': stat.count}
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP]
+    ]
+    return {
+        'stats_file': str(PROFILE_FILE),
+        'hot_functions': functions[:PROFILE_TOP],
+        'traced_memory': {'current_bytes': current, 'peak_bytes': peak},
+        'top_allocations': allocations,
+    }
+
+def save_report(report):
+    """Atomically write build-report.json"""
+    tmp = REPORT_FILE.with_name(REPORT_FILE.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, REPORT_FILE)
+
+def write_page(target, func, args):
+    """Render one page with func(*args) and write it to target.
+
+    func may return the page as one string or as an iterable of fragments,
+    which are streamed through a buffered file handle as they are produced.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    content = func(*args)
+    with open(target, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        if isinstance(content, str):
+            f.write(content)
+        else:
+            f.writelines(content)
+
+def render_text(text):
+    """Render function for outputs that are already a string"""
+    return text
+
+def _render_state():
+    """Module state the page templates read, to hand to render workers"""
+    return {
+        'MEDIA_INDEX': MEDIA_INDEX, 'MEDIA_NAMES': MEDIA_NAMES, 'THUMBNAILS': THUMBNAILS,
+        'DIMENSIONS': DIMENSIONS, 'LINK_PREVIEWS': LINK_PREVIEWS, 'STYLESHEET': STYLESHEET,
+        'VIDEOS': VIDEOS,
+    }
+
+def _init_render_worker(state):
+    globals().update(state)
+
+def _render_job(job):
+    name, func, args = job
+    write_page(STAGING_DIR / name, func, args)
+    return name
+
+@contextmanager
+def build_lock():
+    """Hold an exclusive lock on the output directory for the length of a build.
+
+    Keeps a --watch process and a manual run from interleaving their
+    staging directories and manifests.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(LOCK_FILE, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Waiting for another build in this directory to finish...")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+class RenderScheduler:
+    """Collect the pages of a build and render the changed ones in parallel.
+
+    Pages render into STAGING_DIR and are renamed into OUTPUT_DIR only once all succeed.
+    """
+
+    def __init__(self, old_pages, new_pages):
+        self.old_pages = old_pages
+        self.new_pages = new_pages
+        self.jobs = []
+        self.written = []
+
+    def add(self, name, key, func, *args):
+        """Queue a page for rendering if its inputs changed; returns True if queued.
+
+        func and args must be picklable (module-level functions and plain
+        data), as they are sent to a worker process.
+        """
+        self.new_pages[name] = key
+        if self.old_pages.get(name) == key and (OUTPUT_DIR / name).exists():
+            REPORT.count('pages.skipped')
+            return False
+        self.jobs.append((name, func, args))
+        return True
+
+    def run(self, workers=1):
+        """Render every queued page into the staging directory, then promote them"""
+        if STAGING_DIR.exists():
+            shutil.rmtree(STAGING_DIR)  # left over from a crashed build
+        if not self.jobs:
+            return 0
+        STAGING_DIR.mkdir(parents=True)
+
+        with REPORT.phase('render'):
+            if workers <= 1 or len(self.jobs) < RENDER_POOL_MIN_PAGES:
+                for job in self.jobs:
+                    _render_job(job)
+            else:
+                chunksize = max(1, len(self.jobs) // (workers * 4))
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                                         initargs=(_render_state(),)) as pool:
+                    for _ in pool.map(_render_job, self.jobs, chunksize=chunksize):
+                        pass
+
+        with REPORT.phase('write'):
+            for name, _, _ in self.jobs:
+                target = OUTPUT_DIR / name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                staged = STAGING_DIR / name
+                REPORT.count('pages.bytes_written', staged.stat().st_size)
+                os.replace(staged, target)
+            shutil.rmtree(STAGING_DIR)
+        REPORT.count('pages.written', len(self.jobs))
+        self.written = [name for name, _, _ in self.jobs]
+        self.jobs = []
+        return len(self.written)
+
+def remove_orphans(old_entries, new_entries, directory):
+    """Delete outputs recorded by the previous build that this build no longer produces"""
+    removed = 0
+    for name in old_entries:
+        if name in new_entries:
+            continue
+        target = directory / name
+        if target.is_file():
+            target.unlink()
+            removed += 1
+    if removed:
+        print(f"Removed {removed} stale outputs from {directory}")
+    REPORT.count('files.removed', removed)
+    return removed
+
+def media_key(uri):
+    """Path of a media URI relative to the export's posts/media folder"""
+    uri = str(uri).replace('\\', '/')
+    marker = 'posts/media/'
+    if marker in uri:
+        return uri.split(marker, 1)[1]
+    return Path(uri).name
+
+def hashed_media_name(digest, filename):
+    """Content-addressed output name for a media file"""
+    return digest[:HASHED_NAME_LENGTH] + Path(filename).suffix.lower()
+
+def _write_sibling(path, suffix, data):
+    """Atomically write path + suffix, or remove it when compression didn't help"""
+    target = path.with_name(path.name + suffix)
+    if data is None:
+        if target.exists():
+            target.unlink()
+        return 0
+    tmp = target.with_name(f".{target.name}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, target)
+    return len(data)
+
+def _precompress_file(path, previous_hash):
+    """Write .gz and .br siblings of one file at maximum compression (runs in a worker process).
+
+    Returns the file's hash and how many compressed bytes were written, or
+    None for the bytes when the hash matched and the siblings already exist.
+    """
+    data = path.read_bytes()
+    digest = hash_bytes(data)
+    has_siblings = path.with_name(path.name + '.gz').exists() or len(data) < PRECOMPRESS_MIN_SIZE
+    if digest == previous_hash and has_siblings:
+        return digest, None
+
+    written = 0
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    written += _write_sibling(path, '.gz', compressed if len(compressed) < len(data) else None)
+    if brotli is not None:
+        compressed = brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+        written += _write_sibling(path, '.br', compressed if len(compressed) < len(data) else None)
+    else:
+        # A .br left by a build that had brotli would now be stale
+        _write_sibling(path, '.br', None)
+    return digest, written
+
+def remove_precompressed(root):
+    """Delete every .gz/.br sibling recorded in root's precompress manifest, and the manifest"""
+    root = Path(root)
+    manifest_path = root / PRECOMPRESS_MANIFEST
+    if not manifest_path.exists():
+        return
+    for rel in load_json(manifest_path) or {}:
+        for suffix in ('.gz', '.br'):
+            _write_sibling(root / rel, suffix, None)
+    manifest_path.unlink()
+    print(f"Removed precompressed siblings from {root}")
+
+def precompress_tree(root, workers=1, exclude=()):
+    """Write .gz/.br siblings for every text asset under root, for gzip_static/brotli_static.
+
+    A manifest in root records each file's size, mtime, hash and encoders,
+    so only files whose content or available encoders changed are
+    recompressed, and siblings of deleted files are removed. Subdirectories with their own manifest are skipped,
+    as they are precompressed separately. Returns (compressed, total) counts.
+    """
+    root = Path(root)
+    manifest_path = root / PRECOMPRESS_MANIFEST
+    old = load_json(manifest_path) if manifest_path.exists() else None
+    old = old or {}
+    exclude = {Path(p).resolve() for p in exclude}  # directories or single files
+    encoders = ['gz', 'br'] if brotli is not None else ['gz']
+
+    files = {}
+    jobs = {}
+    for dirpath, dirs, filenames in os.walk(root):
+        here = Path(dirpath)
+        resolved = here.resolve()
+        dirs[:] = sorted(
+            d for d in dirs
+            if not d.startswith('.') and resolved / d not in exclude
+            and not (here / d / PRECOMPRESS_MANIFEST).exists()
+        )
+        for name in filenames:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS) or name.startswith('.') or resolved / name in exclude:
+                continue
+            path = here / name
+            rel = path.relative_to(root).as_posix()
+            st = path.stat()
+            previous = old.get(rel)
+            if previous and previous.get('encoders', ['gz']) != encoders:
+                previous = None  # brotli was installed or removed since: rewrite every sibling
+            if previous and previous['size'] == st.st_size and previous['mtime_ns'] == st.st_mtime_ns:
+                files[rel] = previous
+            else:
+                files[rel] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': None, 'encoders': encoders}
+                jobs[rel] = (path, previous['hash'] if previous else None)
+
+    compressed = 0
+    compressed_bytes = 0
+    start = time.perf_counter()
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_precompress_file, path, previous): rel
+                       for rel, (path, previous) in jobs.items()}
+            for future in as_completed(futures):
+                rel = futures[future]
+                try:
+                    digest, written = future.result()
+                except OSError as e:
+                    print(f"Error compressing {rel}: {e}")
+                    del files[rel]
+                    continue
+                files[rel]['hash'] = digest
+                if written is not None:
+                    compressed += 1
+                    compressed_bytes += written
+
+    for rel in old:
+        if rel not in files:
+            path = root / rel
+            for suffix in ('.gz', '.br'):
+                _write_sibling(path, suffix, None)
+
+    tmp = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(files, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+    REPORT.count('precompress.files', len(files))
+    REPORT.count('precompress.compressed', compressed)
+    REPORT.count('precompress.bytes_written', compressed_bytes)
+    print(f"Precompressed {compressed} of {len(files)} files under {root} "
+          f"({compressed_bytes / 1e6:.1f} MB written) in {time.perf_counter() - start:.2f}s"
+          + ("" if brotli else "; brotli is not installed, wrote .gz only"))
+    return compressed, len(files)
+
+def _exif_orientation_segment(orientation):
+    """A minimal APP1 EXIF segment carrying only the orientation tag"""
+    tiff = b'MM\x00\x2a' + struct.pack('>I', 8) + struct.pack('>H', 1)
+    tiff += struct.pack('>HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack('>I', 0)
+    payload = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+def _is_srgb_profile(profile):
+    """True if an ICC profile's description names sRGB (as ASCII or UTF-16 text)"""
+    return b'sRGB' in profile or 'sRGB'.encode('utf-16-be') in profile
+
+def strip_jpeg(data):
+    """Drop metadata segments from a JPEG without touching the compressed image data.
+
+    EXIF (with its embedded thumbnail), XMP, FlashPix, Photoshop and comment
+    segments go. An orientation other than 1 is kept in a minimal EXIF
+    segment, and ICC profiles are kept unless they are sRGB (which browsers
+    assume anyway), so the image displays exactly as before. JFIF and Adobe
+    segments are kept, as decoders rely on them.
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("not a JPEG")
+    out = [b'\xff\xd8']
+    icc = []
+    icc_at = exif_at = None
+    orientation = 1
+    pos = 2
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            raise ValueError(f"bad JPEG marker at {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            out.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        if marker in (0xDA, 0xD9):  # start of scan: the rest is image data
+            out.append(data[pos:])
+            break
+        end = pos + 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segment, body = data[pos:end], data[pos + 4:end]
+        pos = end
+        if marker == 0xE1:
+            if body.startswith(b'Exif\x00\x00') and exif_at is None:
+                orientation = _jpeg_orientation(body)
+                exif_at = len(out)
+        elif marker == 0xE2:
+            if body.startswith(b'ICC_PROFILE\x00'):
+                if icc_at is None:
+                    icc_at = len(out)
+                icc.append(segment)
+        elif 0xE3 <= marker <= 0xED or marker in (0xEF, 0xFE):
+            continue
+        else:
+            out.append(segment)
+
+    # Insert back-to-front so the earlier index stays valid
+    inserts = []
+    if icc and not _is_srgb_profile(b''.join(icc)):
+        inserts.append((icc_at, b''.join(icc)))
+    if orientation != 1:
+        inserts.append((exif_at, _exif_orientation_segment(orientation)))
+    for at, segment in sorted(inserts, reverse=True):
+        out.insert(at, segment)
+    return b''.join(out)
+
+def strip_png(data):
+    """Drop ancillary PNG chunks that don't affect display and repack the image data.
+
+    IDAT chunks are merged and their zlib stream recompressed at level 9 when
+    that is smaller; this inflates the filtered scanlines but never decodes
+    pixels. An sRGB iCCP profile is dropped, as with JPEGs.
+    """
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("not a PNG")
+    chunks = []
+    idat = []
+    pos = 8
+    while pos + 12 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if kind == b'IDAT':
+            if not idat:
+                chunks.append((b'IDAT', None))
+            idat.append(body)
+        elif kind in PNG_KEEP_CHUNKS:
+            if kind == b'iCCP':
+                name, _, profile = body.partition(b'\x00')
+                if b'sRGB' in name or _is_srgb_profile(zlib.decompress(profile[1:])):
+                    continue
+            chunks.append((kind, body))
+        if kind == b'IEND':
+            break
+    if not idat:
+        raise ValueError("PNG has no image data")
+
+    stream = b''.join(idat)
+    packed = zlib.compress(zlib.decompress(stream), 9)
+    if len(packed) < len(stream):
+        stream = packed
+
+    out = [data[:8]]
+    for kind, body in chunks:
+        body = stream if body is None else body
+        out.append(struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body)))
+    return b''.join(out)
+
+def _optimize_image(path):
+    """Strip one image in place if that makes it smaller (runs in a worker process).
+
+    Returns (hash of the resulting file, bytes saved). The new file is
+    written beside the old one and renamed over it, so a hardlinked copy
+    never changes the export it points at.
+    """
+    data = Path(path).read_bytes()
+    stripped = strip_png(data) if data[:8] == b'\x89PNG\r\n\x1a\n' else strip_jpeg(data)
+    if len(stripped) >= len(data):
+        return hash_bytes(data), 0
+    tmp = path.with_name(path.name + '.optimize')
+    tmp.write_bytes(stripped)
+    os.replace(tmp, path)
+    return hash_bytes(stripped), len(data) - len(stripped)
+
+def optimize_images(root, workers=1):
+    """Losslessly strip metadata from every JPEG and PNG under root, in a process pool.
+
+    A manifest in root records each file's size, mtime and hash; files
+    whose stat is unchanged are skipped, and so is any file whose hash is
+    one this tree has already produced or found nothing to strip from, so
+    reruns only stat. The export and subdirectories with their own
+    manifest are left alone. Prints and returns bytes saved per directory.
+    """
+    root = Path(root)
+    manifest_path = root / OPTIMIZE_MANIFEST
+    old = load_json(manifest_path) if manifest_path.exists() else None
+    old = old or {}
+    done = {entry['hash'] for entry in old.values()}
+
+    files = {}
+    jobs = {}
+    for dirpath, dirs, filenames in os.walk(root):
+        here = Path(dirpath)
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != ARCHIVE_DIR.name
+                         and not (here / d / OPTIMIZE_MANIFEST).exists())
+        for name in filenames:
+            if not name.lower().endswith(OPTIMIZE_EXTENSIONS):
+                continue
+            path = here / name
+            rel = path.relative_to(root).as_posix()
+            st = path.stat()
+            previous = old.get(rel)
+            if previous and previous['size'] == st.st_size and previous['mtime_ns'] == st.st_mtime_ns:
+                files[rel] = previous
+                continue
+            digest = hash_file(path)
+            if digest in done:
+                files[rel] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest,
+                              'saved': previous['saved'] if previous and previous['hash'] == digest else 0}
+            else:
+                jobs[rel] = path
+
+    saved = {}
+    optimized = 0
+    start = time.perf_counter()
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_optimize_image, path): rel for rel, path in jobs.items()}
+            for future in as_completed(futures):
+                rel = futures[future]
+                try:
+                    digest, shaved = future.result()
+                    optimized += 1
+                except (OSError, ValueError, struct.error, zlib.error) as e:
+                    # Remember the file as-is so a broken image isn't retried every build
+                    print(f"Error optimizing {rel}: {e}")
+                    digest, shaved = hash_file(jobs[rel]), 0
+                st = jobs[rel].stat()
+                files[rel] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest, 'saved': shaved}
+                if shaved:
+                    directory = rel.rsplit('/', 1)[0] if '/' in rel else '.'
+                    saved[directory] = saved.get(directory, 0) + shaved
+
+    tmp = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(files, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+    total = sum(saved.values())
+    lifetime = sum(entry.get('saved', 0) for entry in files.values())
+    REPORT.count('images.optimized', optimized)
+    REPORT.count('images.bytes_saved', total)
+    print(f"Optimized {optimized} of {len(files)} images under {root} in {time.perf_counter() - start:.2f}s: "
+          f"saved {total / 1e6:.2f} MB now, {lifetime / 1e6:.2f} MB in total")
+    for directory, count in sorted(saved.items(), key=lambda item: -item[1]):
+        print(f"  {count / 1024:8.0f} KB  {directory}")
+    return saved
+
+class ZipMember:
+    """A file inside an export ZIP part, usable where the loaders expect a Path.
+
+    It stands in for its own stat result (st_size and st_mtime_ns from the
+    zip directory), so the size/mtime checks of the caches work unchanged.
+    Members are plain picklable records; each thread or worker process
+    opens its own handle on a part (see _zip_handle), so parallel readers
+    never contend on one file position.
+    """
+
+    def __init__(self, archive, version, info):
+        self.archive = archive
+        self.version = version
+        self.member = info.filename
+        self.name = info.filename.rsplit('/', 1)[-1]
+        self.stem = self.name.rsplit('.', 1)[0]
+        self.st_size = info.file_size
+        self.st_mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+
+    def stat(self):
+        return self
+
+    def as_posix(self):
+        return f"{self.archive}:{self.member}"
+
+    def __str__(self):
+        return self.as_posix()
+
+    def open(self, mode='rb'):
+        stream = _zip_handle(self.archive, self.version).open(self.member)
+        return stream if mode == 'rb' else io.TextIOWrapper(stream, encoding='utf-8')
+
+_ZIP_HANDLES = threading.local()
+
+def _zip_handle(archive, version):
+    """This thread's open ZipFile for an export part, reading the central directory once.
+
+    Handles are dropped when the part changes (watch mode) and after a
+    fork, since a forked worker would share the parent's file offset.
+    """
+    if getattr(_ZIP_HANDLES, 'pid', None) != os.getpid():
+        _ZIP_HANDLES.pid = os.getpid()
+        _ZIP_HANDLES.handles = {}
+    handles = _ZIP_HANDLES.handles
+    if archive not in handles or handles[archive][0] != version:
+        if archive in handles:
+            handles[archive][1].close()
+        handles[archive] = (version, zipfile.ZipFile(archive))
+    return handles[archive][1]
+
+def export_index():
+    """Map paths under ARCHIVE_DIR to ZipMembers across every export part.
+
+    Members are found wherever the export folder sits inside a part, and a
+    path present in several parts comes from the first. The index is
+    rebuilt only when a part's size or mtime changes.
+    """
+    parts = {}
+    for archive in EXPORT_ZIPS:
+        st = os.stat(archive)
+        parts[archive] = (st.st_size, st.st_mtime_ns)
+    if EXPORT_INDEX.get('parts') == parts:
+        return EXPORT_INDEX['members']
+
+    members = {}
+    marker = ARCHIVE_DIR.name + '/'
+    for archive, version in parts.items():
+        for info in _zip_handle(archive, version).infolist():
+            _, found, rel = info.filename.partition(marker)
+            if found and rel and not info.is_dir():
+                members.setdefault(rel, ZipMember(archive, version, info))
+    EXPORT_INDEX.update(parts=parts, members=members)
+    return members
+
+def _walk_order(rel):
+    """Sort key that lists paths the way a sorted os.walk() visits them: files before subdirectories"""
+    parts = rel.split('/')
+    return [(1, part) for part in parts[:-1]] + [(0, parts[-1])]
+
+def export_files(subdir, recursive=True):
+    """Map paths under an export subdirectory to their sources, in sorted walk order.
+
+    Sources are Paths into ARCHIVE_DIR, or ZipMembers when building from
+    export ZIP parts.
+    """
+    if EXPORT_ZIPS:
+        prefix = subdir + '/'
+        found = [(rel[len(prefix):], member) for rel, member in export_index().items() if rel.startswith(prefix)]
+        if not recursive:
+            found = [(rel, member) for rel, member in found if '/' not in rel]
+        return dict(sorted(found, key=lambda item: _walk_order(item[0])))
+
+    root = ARCHIVE_DIR / subdir
+    files = {}
+    for dirpath, dirs, names in os.walk(root):
+        dirs[:] = sorted(dirs) if recursive else []
+        for name in sorted(names):
+            path = Path(dirpath) / name
+            files[path.relative_to(root).as_posix()] = path
+    return files
+
+def open_export(source):
+    """Open an export JSON file or ZIP member as UTF-8 text, streamed"""
+    if isinstance(source, ZipMember):
+        return source.open('r')
+    return open(source, 'r', encoding='utf-8')
+
 def get_media_path(uri):
     """Convert archive URI to output media path"""
     if not uri:
         return None
-    # Extract just the filename and put in media folder
-    filename = Path(uri).name
+    filename = MEDIA_INDEX.get(media_key(uri))
+    if filename is None:
+        # Extract just the filename and put in media folder
+        filename = Path(uri).name
+        filename = MEDIA_NAMES.get(filename, filename)
     return f"media/{filename}"
 
-def copy_media_files():
-    """Copy all media files to output directory"""
+def media_outputs(media):
+    """Set of output filenames referenced by a media manifest"""
+    return {entry.get('output', Path(key).name) for key, entry in media.items()}
+
+def page_media_inputs(posts=(), paths=()):
+    """Media paths, sizes, thumbnails, videos and link previews a page renders.
+
+    Part of each page's manifest key, so a media change only re-renders the pages showing it.
+    """
+    paths = [p for p in paths if p]
+    previews = {}
+    for post in posts:
+        paths.extend(get_media_path(m['uri']) for m in post['media'])
+        preview = LINK_PREVIEWS.get(post['external_url'])
+        if preview:
+            previews[post['external_url']] = [preview['title'], preview.get('description'),
+                                              preview.get('site_name'), preview.get('local_image')]
+            if preview.get('local_image'):
+                paths.append(preview['local_image'])
+    media = {}
+    for path in paths:
+        name = path[len("media/"):]
+        media[name] = [DIMENSIONS.get(name), THUMBNAILS.get(name), VIDEOS.get(name)]
+    return [paths, media, previews]
+
+def _try_reflink(src, dst):
+    """Clone src into dst with the Linux FICLONE ioctl; False if unsupported"""
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            return False
+
+def _kernel_copy(src, dst):
+    """Copy file contents in-kernel with copy_file_range, then sendfile, then userspace"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        for name in ('copy_file_range', 'sendfile'):
+            func = getattr(os, name, None)
+            if func is None:
+                continue
+            try:
+                offset = 0
+                while offset < remaining:
+                    if name == 'copy_file_range':
+                        sent = func(fsrc.fileno(), fdst.fileno(), remaining - offset)
+                    else:
+                        sent = func(fdst.fileno(), fsrc.fileno(), offset, remaining - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                if offset == remaining:
+                    return name
+            except OSError:
+                pass
+            # Start over with the next method
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        return 'copy'
+
+def copy_file_fast(src, dst, link_mode='auto'):
+    """Copy src to dst with the cheapest method available, returning its name.
+
+    ``auto`` tries a reflink, then a hardlink when both paths are on the same
+    filesystem, then an in-kernel copy. The result is always staged in a temp
+    file and renamed over dst, so writing never goes through an existing
+    hardlink back into the source.
+    """
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    if tmp.exists():
+        tmp.unlink()
+    same_fs = os.stat(src).st_dev == os.stat(dst.parent).st_dev
+    method = None
+
+    if link_mode in ('auto', 'reflink') and same_fs and _try_reflink(src, tmp):
+        method = 'reflink'
+    elif link_mode in ('auto', 'hardlink') and same_fs:
+        try:
+            if tmp.exists():
+                tmp.unlink()
+            os.link(src, tmp)
+            method = 'hardlink'
+        except OSError:
+            pass
+
+    if method is None:
+        method = _kernel_copy(src, tmp)
+    if method != 'hardlink':
+        shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    return method
+
+def _hash_media_file(src):
+    """Stat and hash one media file (runs in a worker thread)"""
+    st = src.stat()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': hash_file(src)}
+
+def _extract_media_member(member, tmp):
+    """Decompress a ZIP member into tmp while hashing it (runs in a worker thread).
+
+    Hashing and extraction share one pass, so a new file is inflated once;
+    the copy stage then only renames tmp into place.
+    """
+    digest = hashlib.sha256()
+    with member.open() as fsrc, open(tmp, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(ZIP_COPY_CHUNK), b''):
+            digest.update(chunk)
+            fdst.write(chunk)
+    mtime = member.st_mtime_ns / 1e9
+    os.utime(tmp, (mtime, mtime))
+    return {'size': member.st_size, 'mtime_ns': member.st_mtime_ns, 'hash': digest.hexdigest()}
+
+def extract_member(member, dst):
+    """Copy a ZIP member to dst through a temp file, returning the copy method's name"""
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    _extract_media_member(member, tmp)
+    os.replace(tmp, dst)
+    return 'unzip'
+
+def copy_media_files(old_media=None, workers=1, link_mode='auto', layout='flat'):
+    """Copy new or changed media files to output directory.
+
+    Files with the size and mtime recorded in ``old_media`` are not rehashed.
+    ``layout='hashed'`` names outputs by content hash instead of basename.
+    Fills MEDIA_INDEX and returns the updated media manifest.
+    """
+    if old_media is None:
+        old_media = {}
     MEDIA_OUTPUT.mkdir(exist_ok=True)
 
-    media_source = ARCHIVE_DIR / "posts" / "media"
-    if media_source.exists():
-        for root, dirs, files in os.walk(media_source):
-            for file in files:
-                if file.endswith(('.jpg', '.jpeg', '.png', '.gif', '.mp4', '.webp')):
-                    src = Path(root) / file
-                    dst = MEDIA_OUTPUT / file
-                    if not dst.exists():
-                        shutil.copy2(src, dst)
-                        print(f"Copied: {file}")
-
-def load_posts():
-    """Load all posts from profile_posts JSON"""
-    posts_file = ARCHIVE_DIR / "posts" / "profile_posts_1.json"
-    data = load_json(posts_file)
-    if not data:
-        return []
+    media = {}
+    sources = {}
+    to_hash = []
+    for key, src in export_files("posts/media").items():
+        if not key.endswith(MEDIA_EXTENSIONS):
+            continue
+        sources[key] = src
+        st = src.stat()
+        previous = old_media.get(key)
+        if (previous and previous['size'] == st.st_size
+                and previous['mtime_ns'] == st.st_mtime_ns):
+            media[key] = dict(previous)
+        else:
+            to_hash.append(key)
+
+    copied = 0
+    copied_bytes = 0
+    methods = {}
+    extracted = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {}
+        for key in to_hash:
+            if isinstance(sources[key], ZipMember):
+                extracted[key] = MEDIA_OUTPUT / f".unzip-{hash_bytes(key)[:HASHED_NAME_LENGTH]}.tmp"
+                futures[pool.submit(_extract_media_member, sources[key], extracted[key])] = key
+            else:
+                futures[pool.submit(_hash_media_file, sources[key])] = key
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                media[key] = future.result()
+            except OSError as e:
+                print(f"Error reading {key}: {e}")
+
+        # Assign output names; the walk order above makes "first wins" stable
+        outputs = {}
+        for key in sources:
+            entry = media.get(key)
+            if entry is None:
+                continue
+            if layout == 'hashed':
+                entry['output'] = hashed_media_name(entry['hash'], key)
+            else:
+                entry['output'] = Path(key).name
+                entry.pop('shadowed_by', None)
+                winner = outputs.get(entry['output'])
+                if winner and media[winner]['hash'] != entry['hash']:
+                    entry['shadowed_by'] = winner
+                    print(f"Warning: {key} is shadowed by {winner} (same filename, different content)")
+            outputs.setdefault(entry['output'], key)
+
+        old_hashes = {e.get('output', Path(k).name): e['hash']
+                      for k, e in old_media.items() if 'shadowed_by' not in e}
+        futures = {}
+        for output, key in outputs.items():
+            dst = MEDIA_OUTPUT / output
+            if dst.exists() and (layout == 'hashed' or old_hashes.get(output) == media[key]['hash']):
+                continue
+            if 'duplicate_of' in media[key]:
+                # Removed by dedupe_images(), which restores it if it stops being a duplicate
+                continue
+            if key in extracted:
+                os.replace(extracted.pop(key), dst)
+                copied += 1
+                copied_bytes += media[key]['size']
+                methods['unzip'] = methods.get('unzip', 0) + 1
+            elif isinstance(sources[key], ZipMember):
+                futures[pool.submit(extract_member, sources[key], dst)] = (output, key)
+            else:
+                futures[pool.submit(copy_file_fast, sources[key], dst, link_mode)] = (output, key)
+        for future in as_completed(futures):
+            output, key = futures[future]
+            try:
+                method = future.result()
+            except OSError as e:
+                print(f"Error copying {key}: {e}")
+                continue
+            copied += 1
+            copied_bytes += media[key]['size']
+            methods[method] = methods.get(method, 0) + 1
+    # Extracted files that turned out to be unchanged or shadowed
+    for tmp in extracted.values():
+        tmp.unlink(missing_ok=True)
+    elapsed = time.perf_counter() - start
+
+    REPORT.count('media.files', len(sources))
+    REPORT.count('media.copied', copied)
+    REPORT.count('media.skipped', len(outputs) - copied)
+    REPORT.count('media.bytes_copied', copied_bytes)
+    REPORT.count('cache.media.hits', len(sources) - len(to_hash))
+    REPORT.count('cache.media.misses', len(to_hash))
+    for method, count in methods.items():
+        REPORT.count(f"media.copied_by.{method}", count)
+
+    MEDIA_INDEX.clear()
+    MEDIA_NAMES.clear()
+    for key, entry in media.items():
+        MEDIA_INDEX[key] = entry['output']
+        MEDIA_NAMES.setdefault(Path(key).name, entry['output'])
+
+    if copied:
+        rate = max(elapsed, 1e-9)
+        breakdown = ", ".join(f"{count} {name}" for name, count in sorted(methods.items()))
+        print(f"Copied {copied} files ({copied_bytes / 1e6:.1f} MB) in {elapsed:.2f}s: "
+              f"{copied / rate:.0f} files/s, {copied_bytes / 1e6 / rate:.1f} MB/s ({breakdown})")
+    if len(outputs) < len(media):
+        print(f"{len(media)} media files stored as {len(outputs)} outputs")
+    return media
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, arithmetic...)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _jpeg_orientation(exif):
+    """EXIF orientation tag (1-8) from an APP1 payload, or 1"""
+    if not exif.startswith(b'Exif\0\0') or len(exif) < 14:
+        return 1
+    tiff = exif[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None:
+        return 1
+    ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if ifd + 2 > len(tiff):
+        return 1
+    count = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+    for i in range(count):
+        entry = tiff[ifd + 2 + i * 12:ifd + 14 + i * 12]
+        if len(entry) < 12:
+            break
+        tag, kind = struct.unpack(endian + 'HH', entry[:4])
+        if tag == 0x0112:
+            return struct.unpack(endian + 'H', entry[8:10])[0] if kind == 3 else 1
+    return 1
+
+def _jpeg_size(f):
+    """Walk JPEG marker segments up to the first SOF, seeking past everything else"""
+    f.seek(2)
+    orientation = 1
+    while True:
+        marker = f.read(2)
+        while marker[:1] == b'\xff' and marker[1:] == b'\xff':
+            marker = marker[1:] + f.read(1)  # fill bytes
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code in (0x01, 0xD8) or 0xD0 <= code <= 0xD7:
+            continue  # standalone markers have no length
+        if code in (0xD9, 0xDA):
+            return None  # end of image / start of scan before any frame header
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        length = struct.unpack('>H', header)[0] - 2
+        if code in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+        if code == 0xE1 and orientation == 1:
+            orientation = _jpeg_orientation(f.read(length))
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+def read_image_size(path):
+    """Return (width, height) of a JPEG, PNG, GIF or WebP without decoding pixels.
+
+    Only the headers are read (for JPEG, the marker segments up to the frame
+    header), so this costs one or two small reads per file. JPEG sizes are
+    swapped for EXIF rotations, matching what browsers display. Returns None
+    for anything unrecognised.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(32)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            chunk = head[12:16]
+            if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+                f.seek(26)
+                w, h = struct.unpack('<HH', f.read(4))
+                return w & 0x3FFF, h & 0x3FFF
+            if chunk == b'VP8L' and head[20:21] == b'\x2f':
+                b = head[21:25]
+                w = 1 + (((b[1] & 0x3F) << 8) | b[0])
+                h = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+                return w, h
+            if chunk == b'VP8X':
+                w = 1 + int.from_bytes(head[24:27], 'little')
+                h = 1 + int.from_bytes(f.read(3), 'little')
+                return w, h
+            return None
+        if head[:2] == b'\xff\xd8':
+            return _jpeg_size(f)
+    return None
+
+def _read_dimensions(path):
+    try:
+        return read_image_size(path)
+    except (OSError, struct.error):
+        return None
+
+def index_image_dimensions(media, old_dimensions=None, workers=1):
+    """Fill DIMENSIONS for every copied image, reading only new hashes' headers.
+
+    Results are cached by content hash in the manifest, so a warm build does
+    no I/O here at all. Returns {hash: [width, height]} for the manifest;
+    unreadable files are cached as None.
+    """
+    if old_dimensions is None:
+        old_dimensions = {}
+    DIMENSIONS.clear()
+
+    dimensions = {}
+    jobs = {}
+    for key, entry in media.items():
+        digest = entry['hash']
+        if digest in dimensions or digest in jobs or key.lower().endswith('.mp4'):
+            continue
+        if digest in old_dimensions:
+            dimensions[digest] = old_dimensions[digest]
+        else:
+            jobs[digest] = MEDIA_OUTPUT / entry['output']
+
+    REPORT.count('cache.dimensions.hits', len(dimensions))
+    REPORT.count('cache.dimensions.misses', len(jobs))
+    if jobs:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for digest, size in zip(jobs, pool.map(_read_dimensions, jobs.values())):
+                dimensions[digest] = list(size) if size else None
+        print(f"Read {len(jobs)} image headers in {time.perf_counter() - start:.2f}s")
+
+    for entry in media.values():
+        size = dimensions.get(entry['hash'])
+        if size and 'shadowed_by' not in entry:
+            DIMENSIONS[entry['output']] = tuple(size)
+    return dimensions
+
+def _image_fingerprint(path):
+    """[dHash, grid] for an image as displayed, or None if it can't be decoded.
+
+    The dHash has one bit per pair of neighbouring pixels in a 9x8
+    grayscale copy; the grid is a 16x16 grayscale copy (hex) used to
+    confirm matches, since an added caption can leave the dHash unchanged.
+    """
+    try:
+        with Image.open(path) as img:
+            img.draft('L', (DEDUPE_GRID * 8, DEDUPE_GRID * 8))
+            img = ImageOps.exif_transpose(img).convert('L')
+            pixels = img.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BOX).tobytes()
+            grid = img.resize((DEDUPE_GRID, DEDUPE_GRID), Image.BOX).tobytes()
+    except Exception:
+        return None
+    bits = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            left = pixels[row * (DHASH_SIZE + 1) + col]
+            bits = bits << 1 | (left > pixels[row * (DHASH_SIZE + 1) + col + 1])
+    return [bits, grid.hex()]
+
+class BKTree:
+    """Metric tree over Hamming distance for finding every hash within a radius of a query"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value):
+        if self.root is None:
+            self.root = (value, {})
+            return
+        node = self.root
+        while True:
+            distance = bin(node[0] ^ value).count('1')
+            if distance == 0:
+                return
+            if distance not in node[1]:
+                node[1][distance] = (value, {})
+                return
+            node = node[1][distance]
+
+    def query(self, value, radius):
+        found = []
+        pending = [self.root] if self.root else []
+        while pending:
+            node_value, children = pending.pop()
+            distance = bin(node_value ^ value).count('1')
+            if distance <= radius:
+                found.append(node_value)
+            # The triangle inequality rules out every other subtree
+            pending.extend(child for d, child in children.items() if distance - radius <= d <= distance + radius)
+        return found
+
+def _restore_media(media, keys, link_mode):
+    """Copy outputs that a previous build removed as duplicates back from the export"""
+    sources = export_files("posts/media")
+    for key in keys:
+        media[key].pop('duplicate_of', None)
+        dst = MEDIA_OUTPUT / media[key]['output']
+        src = sources.get(key)
+        if dst.exists() or src is None:
+            continue
+        if isinstance(src, ZipMember):
+            extract_member(src, dst)
+        else:
+            copy_file_fast(src, dst, link_mode)
+
+def dedupe_images(media, dimensions, old_fingerprints=None, workers=1, link_mode='auto', distance=DEDUPE_DISTANCE):
+    """Serve one canonical file for each cluster of near-identical photos.
+
+    Pairs within ``distance`` dHash bits whose aspect ratios and grayscale
+    grids agree are clustered; the largest image in a cluster is
+    canonical, and the others' outputs are deleted and marked
+    ``duplicate_of``. Returns {hash: fingerprint} for the manifest.
+    """
+    if old_fingerprints is None:
+        old_fingerprints = {}
+    previous = [key for key, entry in media.items() if 'duplicate_of' in entry]
+    if Image is None:
+        print("Pillow is not installed, skipping near-duplicate detection")
+        _restore_media(media, previous, link_mode)
+        return {}
+
+    outputs = {}
+    for key, entry in media.items():
+        if key.lower().endswith(THUMB_EXTENSIONS) and 'shadowed_by' not in entry:
+            outputs.setdefault(entry['hash'], MEDIA_OUTPUT / entry['output'])
+
+    fingerprints = {digest: old_fingerprints[digest] for digest in outputs if digest in old_fingerprints}
+    # A duplicate removed by an earlier build has to come back to be fingerprinted again
+    _restore_media(media, [key for key in previous if media[key]['hash'] not in fingerprints], link_mode)
+    jobs = {digest: path for digest, path in outputs.items() if digest not in fingerprints and path.exists()}
+    REPORT.count('cache.fingerprints.hits', len(fingerprints))
+    REPORT.count('cache.fingerprints.misses', len(jobs))
+    if jobs:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            for digest, value in zip(jobs, pool.map(_image_fingerprint, jobs.values(), chunksize=32)):
+                fingerprints[digest] = value
+        print(f"Fingerprinted {len(jobs)} images in {time.perf_counter() - start:.2f}s")
+
+    # Cluster distinct hashes with union-find over BK-tree neighbours
+    by_dhash = {}
+    grids = {}
+    for digest, value in fingerprints.items():
+        # A truncated header can report a zero side, which has no aspect ratio to compare
+        if value is not None and dimensions.get(digest) and all(dimensions[digest]):
+            by_dhash.setdefault(value[0], []).append(digest)
+            grids[digest] = bytes.fromhex(value[1])
+    parent = {digest: digest for digests in by_dhash.values() for digest in digests}
+
+    def find(digest):
+        while parent[digest] != digest:
+            parent[digest] = parent[parent[digest]]
+            digest = parent[digest]
+        return digest
+
+    def same_photo(a, b):
+        (wa, ha), (wb, hb) = dimensions[a], dimensions[b]
+        if abs(wa * hb / (ha * wb) - 1) > DEDUPE_ASPECT_TOLERANCE:
+            return False
+        return max(abs(x - y) for x, y in zip(grids[a], grids[b])) <= DEDUPE_MAX_CELL_DIFF
+
+    tree = BKTree()
+    for value in sorted(by_dhash):
+        group = by_dhash[value]
+        candidates = [(a, b) for a, b in zip(group, group[1:])]
+        for neighbour in tree.query(value, distance):
+            candidates.extend((a, b) for a in group for b in by_dhash[neighbour])
+        for a, b in candidates:
+            if same_photo(a, b):
+                parent[find(a)] = find(b)
+        tree.add(value)
+
+    clusters = {}
+    for digest in parent:
+        clusters.setdefault(find(digest), []).append(digest)
+    clusters = [digests for digests in clusters.values() if len(digests) > 1]
+
+    keys_by_hash = {}
+    for key, entry in media.items():
+        keys_by_hash.setdefault(entry['hash'], []).append(key)
+    sizes = {entry['hash']: entry['size'] for entry in media.values()}
+
+    duplicates = {}
+    saved = 0
+    for digests in clusters:
+        canonical = max(digests, key=lambda d: (dimensions[d][0] * dimensions[d][1], sizes[d], d))
+        canonical_key = next(key for key in keys_by_hash[canonical] if 'shadowed_by' not in media[key])
+        for digest in digests:
+            if digest == canonical:
+                continue
+            saved += sizes[digest]
+            for key in keys_by_hash[digest]:
+                if 'shadowed_by' not in media[key]:
+                    duplicates[key] = canonical_key
+                    print(f"Near-duplicate: {key} is served as {canonical_key}")
+
+    _restore_media(media, [key for key in previous if key not in duplicates], link_mode)
+    remapped = {}
+    for key, canonical_key in duplicates.items():
+        media[key]['duplicate_of'] = canonical_key
+        (MEDIA_OUTPUT / media[key]['output']).unlink(missing_ok=True)
+        remapped[media[key]['output']] = media[canonical_key]['output']
+    # Shadowed keys share their winner's output, so remap by output rather than by key
+    references = 0
+    for index in (MEDIA_INDEX, MEDIA_NAMES):
+        for name, output in index.items():
+            if output in remapped:
+                index[name] = remapped[output]
+                references += index is MEDIA_INDEX
+
+    REPORT.count('dedupe.clusters', len(clusters))
+    REPORT.count('dedupe.duplicates', references)
+    REPORT.count('dedupe.bytes_saved', saved)
+    if clusters:
+        print(f"{len(clusters)} near-duplicate clusters: {references} media files served as their canonical copy, "
+              f"saving {saved / 1e6:.1f} MB of storage and of transfer for visitors who see every copy")
+    return {digest: value for digest, value in fingerprints.items() if digest in outputs}
+
+def thumbnail_name(digest, width, ext):
+    """Filename of one resized derivative, keyed by the source hash"""
+    return f"{digest[:HASHED_NAME_LENGTH]}-{width}w{ext}"
+
+def _make_thumbnails(src, digest, widths, webp):
+    """Write resized JPEG (and WebP) derivatives of one image (runs in a worker process).
+
+    Returns the source dimensions and the widths that were produced; widths
+    at or above the source width are skipped.
+    """
+    with Image.open(src) as img:
+        # Let the JPEG decoder downscale by DCT scaling where it can
+        img.draft('RGB', (max(widths), max(widths)))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        width, height = img.size
+        produced = []
+        for w in widths:
+            if w >= width:
+                continue
+            h = max(1, round(height * w / width))
+            resized = img.resize((w, h), Image.LANCZOS)
+            resized.save(THUMBS_OUTPUT / thumbnail_name(digest, w, '.jpg'), 'JPEG',
+                         quality=82, optimize=True, progressive=True)
+            if webp:
+                resized.save(THUMBS_OUTPUT / thumbnail_name(digest, w, '.webp'), 'WEBP', quality=80, method=4)
+            produced.append(w)
+    return {'width': width, 'height': height, 'widths': produced, 'webp': webp}
+
+def generate_thumbnails(media, old_thumbs=None, workers=1, widths=THUMB_WIDTHS):
+    """Produce resized derivatives of every copied image in a process pool.
+
+    Derivatives are named after the source hash, so an image is only
+    resized once no matter how many builds, albums or filenames it appears
+    under. Fills THUMBNAILS and returns {hash: info} for the manifest.
+    """
+    if old_thumbs is None:
+        old_thumbs = {}
+    THUMBNAILS.clear()
+    if Image is None:
+        print("Pillow is not installed, skipping thumbnails")
+        return {}
+    THUMBS_OUTPUT.mkdir(parents=True, exist_ok=True)
+    webp = pil_features.check('webp')
+
+    thumbs = {}
+    jobs = {}
+    for key, entry in media.items():
+        if not key.lower().endswith(THUMB_EXTENSIONS) or 'shadowed_by' in entry or 'duplicate_of' in entry:
+            continue
+        digest = entry['hash']
+        if digest in thumbs or digest in jobs:
+            continue
+        previous = old_thumbs.get(digest)
+        if previous and previous['webp'] == webp and all(
+                (THUMBS_OUTPUT / thumbnail_name(digest, w, '.jpg')).exists() for w in previous['widths']):
+            thumbs[digest] = previous
+        else:
+            jobs[digest] = MEDIA_OUTPUT / entry['output']
+
+    REPORT.count('cache.thumbnails.hits', len(thumbs))
+    REPORT.count('cache.thumbnails.misses', len(jobs))
+    start = time.perf_counter()
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_make_thumbnails, src, digest, widths, webp): digest
+                       for digest, src in jobs.items()}
+            for future in as_completed(futures):
+                digest = futures[future]
+                try:
+                    thumbs[digest] = future.result()
+                except Exception as e:
+                    # Remember the failure so unreadable files aren't retried every build
+                    print(f"Error resizing {jobs[digest].name}: {e}")
+                    thumbs[digest] = {'width': 0, 'height': 0, 'widths': [], 'webp': webp}
+        print(f"Resized {len(jobs)} images in {time.perf_counter() - start:.2f}s")
+
+    # Derivatives of images that are no longer in the export
+    expected = {thumbnail_name(digest, w, ext) for digest, info in thumbs.items()
+                for w in info['widths'] for ext in (('.jpg', '.webp') if info['webp'] else ('.jpg',))}
+    for path in THUMBS_OUTPUT.iterdir():
+        if path.name not in expected:
+            path.unlink()
+
+    for entry in media.values():
+        info = thumbs.get(entry['hash'])
+        if info and 'shadowed_by' not in entry and 'duplicate_of' not in entry:
+            THUMBNAILS[entry['output']] = dict(info, hash=entry['hash'])
+    print(f"{sum(1 for info in thumbs.values() if info['widths'])} images have thumbnails")
+    return thumbs
+
+def iter_mp4_boxes(buf, start=0, end=None):
+    """Yield (type, offset, header size, total size) for the boxes in buf[start:end].
+
+    buf can be bytes, a bytearray or an mmap; only box headers are read.
+    """
+    end = len(buf) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack('>I4s', buf[pos:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise ValueError(f"truncated box header at {pos}")
+            size = struct.unpack('>Q', buf[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:  # extends to the end of the file
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f"bad {kind!r} box size {size} at {pos}")
+        yield kind, pos, header, size
+        pos += size
+
+def _mp4_header_size(box):
+    """Header length of the box at the start of box: 16 with a 64-bit size, else 8"""
+    return 16 if box[:4] == b'\x00\x00\x00\x01' else 8
+
+def _shift_chunk_offsets(moov, start, end, low, high, delta):
+    """Add delta to every stco/co64 entry in [low, high), in place within a moov bytearray"""
+    for kind, pos, header, size in iter_mp4_boxes(moov, start, end):
+        if kind in MP4_CONTAINERS:
+            _shift_chunk_offsets(moov, pos + header, pos + size, low, high, delta)
+        elif kind in (b'stco', b'co64'):
+            fmt, width = ('>I', 4) if kind == b'stco' else ('>Q', 8)
+            count = struct.unpack('>I', moov[pos + header + 4:pos + header + 8])[0]
+            entry = pos + header + 8
+            for _ in range(count):
+                offset = struct.unpack(fmt, moov[entry:entry + width])[0]
+                if low <= offset < high:
+                    offset += delta
+                    if kind == b'stco' and offset > 0xFFFFFFFF:
+                        raise ValueError("chunk offset no longer fits in stco")
+                    moov[entry:entry + width] = struct.pack(fmt, offset)
+                entry += width
+
+def _read_mp4_info(moov):
+    """Duration in seconds and displayed video size from a moov box's mvhd/tkhd"""
+    info = {'duration': None, 'width': None, 'height': None}
 
+    def full_box(pos, header):
+        body = pos + header
+        return moov[body], body + 4
+
+    for kind, pos, header, size in iter_mp4_boxes(moov, _mp4_header_size(moov), len(moov)):
+        if kind == b'mvhd':
+            version, body = full_box(pos, header)
+            if version == 1:
+                timescale, duration = struct.unpack('>IQ', moov[body + 16:body + 28])
+            else:
+                timescale, duration = struct.unpack('>II', moov[body + 8:body + 16])
+            if timescale:
+                info['duration'] = round(duration / timescale, 3)
+        elif kind == b'trak':
+            tkhd = handler = None
+            for child, cpos, cheader, csize in iter_mp4_boxes(moov, pos + header, pos + size):
+                if child == b'tkhd':
+                    tkhd = (cpos, cheader)
+                elif child == b'mdia':
+                    for grandchild, gpos, gheader, _ in iter_mp4_boxes(moov, cpos + cheader, cpos + csize):
+                        if grandchild == b'hdlr':
+                            handler = bytes(moov[gpos + gheader + 8:gpos + gheader + 12])
+            if handler != b'vide' or not tkhd:
+                continue
+            version, body = full_box(*tkhd)
+            body += 32 if version == 1 else 20  # times, track id, duration
+            matrix = struct.unpack('>9i', moov[body + 16:body + 52])
+            width, height = struct.unpack('>II', moov[body + 52:body + 60])
+            width, height = width >> 16, height >> 16
+            if matrix[0] == 0 and matrix[1] != 0:  # rotated a quarter turn
+                width, height = height, width
+            if width and height:
+                info['width'], info['height'] = width, height
+    return info
+
+def faststart_mp4(path):
+    """Move an MP4's moov box in front of its media data, in place.
+
+    The file is read through mmap and the media data streamed into a
+    temporary file in VIDEO_COPY_CHUNK slices, so whole videos are never
+    held in memory; chunk offsets in stco/co64 are shifted by the size of
+    the moved moov. Returns (remuxed, info) with info from _read_mp4_info().
+    Fragmented files (moof) are left alone.
+    """
+    path = Path(path)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("empty file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            boxes = list(iter_mp4_boxes(mm))
+            kinds = [box[0] for box in boxes]
+            if b'moov' not in kinds:
+                raise ValueError("no moov box")
+            moov_box = boxes[kinds.index(b'moov')]
+            moov = bytearray(mm[moov_box[1]:moov_box[1] + moov_box[3]])
+            if b'mdat' not in kinds or kinds.index(b'moov') < kinds.index(b'mdat') or b'moof' in kinds:
+                return False, _read_mp4_info(moov)
+
+            first_mdat = boxes[kinds.index(b'mdat')][1]
+            # Everything from the first mdat up to moov moves back by moov's size
+            _shift_chunk_offsets(moov, _mp4_header_size(moov), len(moov), first_mdat, moov_box[1], moov_box[3])
+            order = [box for box in boxes if box[1] < first_mdat and box[0] != b'moov']
+            order.append(None)
+            order += [box for box in boxes if box[1] >= first_mdat and box[0] != b'moov']
+
+            tmp = path.with_name(path.name + '.faststart')
+            view = memoryview(mm)
+            try:
+                with open(tmp, 'wb') as out:
+                    for box in order:
+                        if box is None:
+                            out.write(moov)
+                            continue
+                        for pos in range(box[1], box[1] + box[3], VIDEO_COPY_CHUNK):
+                            out.write(view[pos:min(pos + VIDEO_COPY_CHUNK, box[1] + box[3])])
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            finally:
+                view.release()
+    os.replace(tmp, path)
+    return True, _read_mp4_info(moov)
+
+def _prepare_video(path):
+    try:
+        return faststart_mp4(path)
+    except (OSError, ValueError, struct.error) as e:
+        return None, str(e)
+
+def prepare_videos(media, old_videos=None, workers=1):
+    """Make every copied MP4 start playing before it has fully downloaded, and index it.
+
+    Each output is checked for a moov box sitting behind its media data
+    (only box headers are read) and remuxed in place when it is; outputs
+    are copies, so the export itself is never modified. Fills VIDEOS with
+    duration and dimensions and returns {hash: info} for the manifest; a
+    video that can't be read keeps the info from the previous build.
+    """
+    if old_videos is None:
+        old_videos = {}
+    VIDEOS.clear()
+
+    outputs = {}
+    for key, entry in media.items():
+        if key.lower().endswith(VIDEO_EXTENSIONS) and 'shadowed_by' not in entry:
+            outputs.setdefault(entry['output'], entry['hash'])
+
+    videos = {}
+    remuxed = 0
+    start = time.perf_counter()
+    if outputs:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(outputs)))) as pool:
+            names = list(outputs)
+            for name, (moved, info) in zip(names, pool.map(_prepare_video, [MEDIA_OUTPUT / n for n in names])):
+                digest = outputs[name]
+                if moved is None:
+                    print(f"Error reading video {name}: {info}")
+                    info = old_videos.get(digest)
+                    if not info:
+                        continue
+                remuxed += bool(moved)
+                videos[digest] = info
+                VIDEOS[name] = info
+    REPORT.count('videos.files', len(outputs))
+    REPORT.count('videos.remuxed', remuxed)
+    if outputs:
+        print(f"Checked {len(outputs)} videos, moved the index to the front of {remuxed} "
+              f"in {time.perf_counter() - start:.2f}s")
+    return videos
+
+def format_duration(seconds):
+    """Video length as m:ss or h:mm:ss"""
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def generate_video_html(src, description):
+    """Generate a <video> tag sized from the video index, so the layout doesn't jump"""
+    info = VIDEOS.get(src[len("media/"):] if src.startswith("media/") else None) or {}
+    attrs = ""
+    if info.get('width') and info.get('height'):
+        attrs = f' width="{info["width"]}" height="{info["height"]}"'
+    label = html.escape(description) or "Video"
+    duration_html = ""
+    if info.get('duration'):
+        duration_html = f'<span class="video-duration">{format_duration(info["duration"])}</span>'
+    return (f'<video controls preload="metadata" src="{src}"{attrs} aria-label="{label}">'
+            f'<a href="{src}">Download video</a></video>{duration_html}')
+
+def generate_img_html(src, alt, css_class=None, sizes=None, loading="lazy", attrs=""):
+    """Generate an <img> tag, with srcset/sizes (and a WebP <picture>) when thumbnails exist.
+
+    ``src`` always stays the full-size original so anything reading it
+    (the lightbox, crawlers, browsers without srcset) gets the real image.
+    """
+    parts = [f'src="{src}"', f'alt="{alt}"']
+    name = src[len("media/"):] if src and src.startswith("media/") else None
+    size = DIMENSIONS.get(name)
+    if size:
+        parts.append(f'width="{size[0]}" height="{size[1]}"')
+    if css_class:
+        parts.append(f'class="{css_class}"')
+    if loading:
+        parts.append(f'loading="{loading}"')
+    if attrs:
+        parts.append(attrs)
+
+    info = THUMBNAILS.get(name) if sizes else None
+    if not info or not info['widths']:
+        return f'<img {" ".join(parts)}>'
+
+    def srcset(ext):
+        candidates = [f"media/thumbs/{thumbnail_name(info['hash'], w, ext)} {w}w" for w in info['widths']]
+        candidates.append(f"{src} {info['width']}w")
+        return ", ".join(candidates)
+
+    parts[1:1] = [f'srcset="{srcset(".jpg")}"', f'sizes="{sizes}"']
+    img = f'<img {" ".join(parts)}>'
+    if not info['webp']:
+        return img
+    return f'<picture><source type="image/webp" srcset="{srcset(".webp")}" sizes="{sizes}">{img}</picture>'
+
+# Characters that can follow a complete JSON number
+JSON_DELIMITERS = frozenset(' \t\r\n,]}')
+
+class JSONStreamReader:
+    """Incrementally decode a JSON document from a text file.
+
+    Only the value currently being decoded is held in memory, so a
+    multi-hundred-MB array of posts can be walked item by item. Arrays and
+    objects can be descended into with iter_array()/iter_object(); anything
+    else is decoded whole with value().
+    """
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        data = self.f.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}, found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode and return the next complete JSON value"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number cut off by the end of the buffer (even right after
+                # '.' or 'e') decodes "successfully", so require a delimiter
+                complete = end < len(self.buf) and (
+                    not isinstance(obj, (int, float)) or isinstance(obj, bool) or self.buf[end] in JSON_DELIMITERS)
+                if complete or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow reads geometrically so one huge value isn't re-parsed per chunk
+            self._fill(size)
+            size *= 2
+
+    def iter_array(self):
+        """Yield each item of the array at the current position"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+
+    def iter_object(self):
+        """Yield each key of the object at the current position.
+
+        The caller must consume the member's value (value() or iter_array())
+        before advancing to the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == '}':
+                self.pos += 1
+                return
+            self.expect(',')
+
+def find_post_shards():
+    """Find every profile_posts_N.json shard, in shard order"""
+    def shard_number(path):
+        suffix = path.stem.rsplit('_', 1)[-1]
+        return int(suffix) if suffix.isdigit() else 0
+
+    shards = [src for name, src in export_files("posts", recursive=False).items()
+              if name.startswith("profile_posts_") and name.endswith(".json")]
+    return sorted(shards, key=shard_number)
+
+def parse_post(item):
+    """Convert one raw export item into a post dict"""
+    post = {
+        'timestamp': item.get('timestamp', 0),
+        'title': decode_facebook_text(item.get('title', '')),
+        'text': '',
+        'media': [],
+        'external_url': None
+    }
+
+    # Extract post text
+    for d in item.get('data', []):
+        if 'post' in d:
+            post['text'] = decode_facebook_text(d['post'])
+            break
+
+    # Extract media and external links
+    for attachment in item.get('attachments', []):
+        for d in attachment.get('data', []):
+            if 'media' in d:
+                media = d['media']
+                post['media'].append({
+                    'uri': media.get('uri'),
+                    'description': decode_facebook_text(media.get('description', ''))
+                })
+            if 'external_context' in d:
+                post['external_url'] = d['external_context'].get('url')
+
+    return post
+
+def load_post_shard(posts_file):
+    """Stream-parse one profile_posts shard into posts, newest first"""
     posts = []
-    for item in data:
-        post = {
-            'timestamp': item.get('timestamp', 0),
-            'title': decode_facebook_text(item.get('title', '')),
-            'text': '',
-            'media': [],
-            'external_url': None
-        }
+    try:
+        with open_export(posts_file) as f:
+            for item in JSONStreamReader(f).iter_array():
+                posts.append(parse_post(item))
+    except Exception as e:
+        print(f"Error loading {posts_file}: {e}")
+        return []
 
-        # Extract post text
-        for d in item.get('data', []):
-            if 'post' in d:
-                post['text'] = decode_facebook_text(d['post'])
-                break
-
-        # Extract media and external links
-        for attachment in item.get('attachments', []):
-            for d in attachment.get('data', []):
-                if 'media' in d:
-                    media = d['media']
-                    post['media'].append({
-                        'uri': media.get('uri'),
-                        'description': decode_facebook_text(media.get('description', ''))
-                    })
-                if 'external_context' in d:
-                    post['external_url'] = d['external_context'].get('url')
-
-        posts.append(post)
-
-    # Sort by timestamp descending (newest first)
     posts.sort(key=lambda x: x['timestamp'], reverse=True)
     return posts
 
-def load_albums():
-    """Load all photo albums"""
-    albums = []
-    album_dir = ARCHIVE_DIR / "posts" / "album"
+def load_parallel(func, paths, workers):
+    """Map func over paths, in a process pool when there's more than one path"""
+    if workers <= 1 or len(paths) <= 1:
+        return [func(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return list(pool.map(func, paths))
 
-    if not album_dir.exists():
-        return albums
+def encode_posts(posts):
+    """Pack a shard's posts into columns for the snapshot"""
+    return {
+        'timestamp': array('q', (p['timestamp'] or 0 for p in posts)).tobytes(),
+        'title': [p['title'] for p in posts],
+        'text': [p['text'] for p in posts],
+        'external_url': [p['external_url'] for p in posts],
+        'media': [tuple((m['uri'], m['description']) for m in p['media']) for p in posts],
+    }
 
-    for album_file in sorted(album_dir.glob("*.json")):
-        data = load_json(album_file)
-        if not data:
+def decode_posts(columns):
+    """Rebuild post dicts from snapshot columns"""
+    timestamps = array('q')
+    timestamps.frombytes(columns['timestamp'])
+    return [
+        {
+            'timestamp': timestamp,
+            'title': title,
+            'text': text,
+            'media': [{'uri': uri, 'description': description} for uri, description in media],
+            'external_url': external_url,
+        }
+        for timestamp, title, text, external_url, media in zip(
+            timestamps, columns['title'], columns['text'], columns['external_url'], columns['media'])
+    ]
+
+def encode_album(album):
+    """Pack one album into columns for the snapshot"""
+    if album is None:
+        return None
+    photos = album['photos']
+    return {
+        'name': album['name'],
+        'description': album['description'],
+        'cover': album['cover'],
+        'uri': [p['uri'] for p in photos],
+        'photo_description': [p['description'] for p in photos],
+        'timestamp': array('q', (p['timestamp'] or 0 for p in photos)).tobytes(),
+    }
+
+def decode_album(columns):
+    """Rebuild an album dict from snapshot columns"""
+    if columns is None:
+        return None
+    timestamps = array('q')
+    timestamps.frombytes(columns['timestamp'])
+    return {
+        'name': columns['name'],
+        'description': columns['description'],
+        'photos': [
+            {'uri': uri, 'description': description, 'timestamp': timestamp}
+            for uri, description, timestamp in zip(columns['uri'], columns['photo_description'], timestamps)
+        ],
+        'cover': columns['cover'],
+    }
+
+SNAPSHOT_CODECS = {
+    'posts': (encode_posts, decode_posts),
+    'album': (encode_album, decode_album),
+}
+
+def load_snapshot():
+    """Load the parsed-export snapshot, or an empty one if missing or outdated"""
+    empty = {'version': SNAPSHOT_VERSION, 'files': {}, 'dirty': False}
+    try:
+        with open(SNAPSHOT_FILE, 'rb') as f:
+            snapshot = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return empty
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return empty
+    snapshot['dirty'] = False
+    snapshot['seen'] = set()
+    return snapshot
+
+def save_snapshot(snapshot):
+    """Write the snapshot if anything changed, dropping files that no longer exist"""
+    seen = snapshot.pop('seen', set())
+    stale = [key for key in snapshot['files'] if key not in seen]
+    if not snapshot.pop('dirty', False) and not stale:
+        return
+    for key in stale:
+        del snapshot['files'][key]
+    tmp = SNAPSHOT_FILE.with_name(SNAPSHOT_FILE.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        marshal.dump(snapshot, f)
+    os.replace(tmp, SNAPSHOT_FILE)
+
+def load_with_snapshot(kind, func, paths, workers, snapshot=None):
+    """Map func over paths like load_parallel(), reusing snapshot records.
+
+    A file whose size and mtime match the snapshot is not opened at all; one
+    whose stat changed but whose hash didn't is reused without parsing.
+    Only the rest go through func (and decode_facebook_text), and their
+    results are stored back into the snapshot.
+    """
+    if snapshot is None:
+        return load_parallel(func, paths, workers)
+    encode, decode = SNAPSHOT_CODECS[kind]
+    files = snapshot['files']
+    snapshot.setdefault('seen', set())
+    results = [None] * len(paths)
+    misses = []
+
+    for i, path in enumerate(paths):
+        key = f"{kind}:{path.as_posix()}"
+        snapshot['seen'].add(key)
+        st = path.stat()
+        entry = files.get(key)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            results[i] = decode(entry['records'])
+            continue
+        digest = hash_file(path)
+        if entry and entry['hash'] == digest:
+            entry['mtime_ns'] = st.st_mtime_ns
+            snapshot['dirty'] = True
+            results[i] = decode(entry['records'])
             continue
+        misses.append((i, path, key, st, digest))
+    REPORT.count('cache.snapshot.hits', len(paths) - len(misses))
+    REPORT.count('cache.snapshot.misses', len(misses))
 
-        album = {
-            'name': decode_facebook_text(data.get('name', 'Untitled Album')),
-            'description': decode_facebook_text(data.get('description', '')),
-            'photos': [],
-            'cover': None
+    for (i, path, key, st, digest), value in zip(misses, load_parallel(func, [m[1] for m in misses], workers)):
+        results[i] = value
+        files[key] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest, 'records': encode(value)}
+        snapshot['dirty'] = True
+    return results
+
+def iter_posts(workers=1, snapshot=None):
+    """Yield posts from every shard merged into one stream, newest first"""
+    shards = load_with_snapshot('posts', load_post_shard, find_post_shards(), workers, snapshot)
+    return heapq.merge(*shards, key=lambda x: x['timestamp'], reverse=True)
+
+def post_slug(post):
+    """Permalink slug: the post's UTC date plus a hash of its content"""
+    date = datetime.fromtimestamp(post['timestamp'], timezone.utc).strftime('%Y-%m-%d')
+    digest = hash_inputs(post['timestamp'], post['title'], post['text'],
+                         [m['uri'] for m in post['media']], post['external_url'])
+    return f"{date}-{digest[:POST_SLUG_HASH_LENGTH]}"
+
+def load_posts(workers=1, snapshot=None):
+    """Load all posts from every profile_posts shard, newest first, with permalink slugs"""
+    posts = list(iter_posts(workers, snapshot))
+    seen = {}
+    for post in posts:
+        slug = post_slug(post)
+        # Identical posts at the same second (double submits) get a counter
+        seen[slug] = seen.get(slug, 0) + 1
+        post['slug'] = slug if seen[slug] == 1 else f"{slug}-{seen[slug]}"
+    return posts
+
+def load_album_file(album_file):
+    """Stream-parse one album JSON file, returning None if it has no photos"""
+    album = {
+        'name': 'Untitled Album',
+        'description': '',
+        'photos': [],
+        'cover': None
+    }
+
+    try:
+        with open_export(album_file) as f:
+            reader = JSONStreamReader(f)
+            for key in reader.iter_object():
+                if key == 'photos':
+                    for photo in reader.iter_array():
+                        album['photos'].append({
+                            'uri': photo.get('uri'),
+                            'description': decode_facebook_text(photo.get('description', '')),
+                            'timestamp': photo.get('creation_timestamp', 0)
+                        })
+                elif key in ('name', 'description'):
+                    album[key] = decode_facebook_text(reader.value())
+                elif key == 'cover_photo':
+                    cover_photo = reader.value()
+                    if cover_photo:
+                        album['cover'] = cover_photo.get('uri')
+                else:
+                    reader.value()
+    except Exception as e:
+        print(f"Error loading {album_file}: {e}")
+        return None
+
+    if not album['cover'] and album['photos']:
+        album['cover'] = album['photos'][0]['uri']
+
+    return album if album['photos'] else None
+
+def load_albums(workers=1, snapshot=None):
+    """Load all photo albums"""
+    album_files = [src for name, src in export_files("posts/album", recursive=False).items()
+                   if name.endswith(".json")]
+    return [album for album in load_with_snapshot('album', load_album_file, album_files, workers, snapshot)
+            if album]
+
+def tokenize(text):
+    """Split text into lowercase, accent-folded search terms.
+
+    Mirrors tokenize() in the search page's script, so queries and the
+    index agree on what a term is.
+    """
+    if not text:
+        return []
+    folded = text.lower()
+    if not folded.isascii():  # NFKD leaves ASCII as it is
+        folded = ''.join(c for c in unicodedata.normalize('NFKD', folded) if not unicodedata.combining(c))
+    return [t for t in re.findall(r'\w+', folded)
+            if len(t) >= 2 and t not in SEARCH_STOPWORDS and not (t.isascii() and t.isdigit())]
+
+def check_search_tokenizer():
+    """Compare the search page's tokenize() with tokenize() on SEARCH_TOKENIZER_SAMPLES (needs node)"""
+    node = shutil.which('node')
+    if node is None:
+        print("node not found; can't run the search page's tokenizer")
+        return False
+    page = generate_search_page()
+    stopwords = re.search(r'const STOPWORDS = .*?;\n', page).group(0)
+    function = re.search(r'function tokenize\(text\) \{.*?\n    \}', page, re.DOTALL).group(0)
+    script = (stopwords + function + "\nlet input = '';\nprocess.stdin.on('data', d => input += d);\n"
+              "process.stdin.on('end', () => console.log(JSON.stringify(JSON.parse(input).map(tokenize))));")
+    result = subprocess.run([node, '-e', script], input=json.dumps(SEARCH_TOKENIZER_SAMPLES),
+                            capture_output=True, text=True, encoding='utf-8', check=True)
+    mismatches = 0
+    for text, terms in zip(SEARCH_TOKENIZER_SAMPLES, json.loads(result.stdout)):
+        if terms != tokenize(text):
+            mismatches += 1
+            print(f"Tokenizers disagree on {text!r}:\n  python: {tokenize(text)}\n  search page: {terms}")
+    print(f"Search tokenizers agree on {len(SEARCH_TOKENIZER_SAMPLES) - mismatches} of "
+          f"{len(SEARCH_TOKENIZER_SAMPLES)} samples")
+    return mismatches == 0
+
+def snippet(text, length=SEARCH_SNIPPET_LENGTH):
+    """Shorten text to a single-line snippet"""
+    text = ' '.join(text.split())
+    return text if len(text) <= length else text[:length - 1].rstrip() + '\u2026'
+
+def build_search_index(posts, albums):
+    """Build an inverted index over post text/titles, album names and photo captions.
+
+    Returns ``(docs, postings)``: docs are ``[url, title, snippet, date]``
+    lists in id order (posts newest first, then albums and photos), and
+    postings map each term to its sorted doc ids.
+    """
+    docs = []
+    postings = {}
+
+    def add(url, title, text, timestamp, *fields):
+        doc_id = len(docs)
+        docs.append([url, title, snippet(text), format_date_short(timestamp)])
+        for term in set(t for field in fields for t in tokenize(field)):
+            postings.setdefault(term, []).append(doc_id)
+
+    for post in posts:
+        captions = ' '.join(m['description'] for m in post['media'])
+        add(post_filename(post), post['title'] or "Deemable Tech", post['text'] or captions, post['timestamp'],
+            post['text'], post['title'], captions)
+
+    for i, album in enumerate(albums):
+        add(f"album-{i}.html", album['name'], album['description'] or f"{len(album['photos'])} photos", 0,
+            album['name'], album['description'])
+        for n, (photo, _) in enumerate(album_photos(album)):
+            if photo['description']:
+                add(page_filename(f"album-{i}", n // ALBUM_PHOTOS_PER_PAGE + 1), album['name'],
+                    photo['description'], photo['timestamp'], photo['description'])
+
+    return docs, postings
+
+def encode_postings(doc_ids):
+    """Delta-encode a sorted list of doc ids"""
+    previous = 0
+    deltas = []
+    for doc_id in doc_ids:
+        deltas.append(doc_id - previous)
+        previous = doc_id
+    return deltas
+
+def shard_postings(postings, max_bytes=SEARCH_SHARD_BYTES, prefix_length=2):
+    """Group terms into shards by prefix, splitting any shard over max_bytes.
+
+    A term lives in the shard with the longest prefix it starts with; terms
+    shorter than a split shard's children stay in the parent. Returns
+    {prefix: {term: deltas}}.
+    """
+    def size(terms):
+        return sum(len(t) + 8 + 4 * len(postings[t]) for t in terms)
+
+    shards = {}
+    pending = [(prefix_length, sorted(postings))]
+    while pending:
+        length, terms = pending.pop()
+        groups = {}
+        for term in terms:
+            groups.setdefault(term[:length], []).append(term)
+        for prefix, group in groups.items():
+            longer = [t for t in group if len(t) > length]
+            if size(group) > max_bytes and longer:
+                shards[prefix] = [t for t in group if len(t) <= length]
+                pending.append((length + 1, longer))
+            else:
+                shards[prefix] = group
+    return {prefix: {t: encode_postings(postings[t]) for t in terms} for prefix, terms in shards.items()}
+
+def shard_filename(prefix):
+    """Filename for an index shard; non-ASCII prefixes are hex-encoded"""
+    if re.fullmatch(r'[a-z0-9_]+', prefix):
+        return f"{SEARCH_DIR}/t-{prefix}.json"
+    return f"{SEARCH_DIR}/x-{prefix.encode('utf-8').hex()}.json"
+
+def write_search_index(posts, albums, scheduler, key=None):
+    """Write the sharded search index consumed by search.html.
+
+    search/shards.json maps term prefixes to shard files, each holding the
+    delta-encoded postings for its terms; search/docs-N.json holds the
+    result metadata in chunks of SEARCH_DOCS_PER_CHUNK. A query fetches the
+    shard list, one shard per term (plus, for the term being typed, the
+    shards split off below it) and one docs chunk per page of results.
+    ``key`` hashes the posts and albums; when it matches the last build the
+    existing files are kept without rebuilding the index.
+    """
+    index_name = f"{SEARCH_DIR}/shards.json"
+    previous = {name: k for name, k in scheduler.old_pages.items() if name.startswith(SEARCH_DIR + '/')}
+    if key and previous.get(index_name) == key and all((OUTPUT_DIR / name).exists() for name in previous):
+        scheduler.new_pages.update(previous)
+        REPORT.count('pages.skipped', len(previous))
+        print(f"Search index unchanged ({len(previous)} files)")
+        return
+
+    docs, postings = build_search_index(posts, albums)
+    shards = shard_postings(postings)
+
+    def dump(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+    files = {f"{SEARCH_DIR}/shards.json": dump({
+        'version': SEARCH_INDEX_VERSION,
+        'chunk': SEARCH_DOCS_PER_CHUNK,
+        'shards': {prefix: shard_filename(prefix).split('/', 1)[1] for prefix in shards},
+    })}
+    for prefix, terms in shards.items():
+        files[shard_filename(prefix)] = dump(terms)
+    for n, start in enumerate(range(0, len(docs), SEARCH_DOCS_PER_CHUNK)):
+        files[f"{SEARCH_DIR}/docs-{n}.json"] = dump(docs[start:start + SEARCH_DOCS_PER_CHUNK])
+
+    for name, content in files.items():
+        scheduler.add(name, key if key and name == index_name else hash_bytes(content), render_text, content)
+    total = sum(len(content.encode('utf-8')) for content in files.values())
+    print(f"Indexed {len(postings)} terms in {len(docs)} documents: "
+          f"{len(shards)} shards, {total / 1024:.0f} KB")
+
+SERVICE_WORKER_SCRIPT = """'use strict';
+// Generated by build_archive.py; VERSION changes whenever the precache manifest does
+const VERSION = '%(version)s';
+const PRECACHE = 'archive-precache';
+const RUNTIME = 'archive-runtime';
+const REVISIONS = new URL('__revisions__', self.registration.scope).href;
+const IMMUTABLE = /%(immutable)s/;
+
+async function loadManifest() {
+    const response = await fetch('%(manifest)s?v=' + VERSION, {cache: 'no-cache'});
+    return response.json();
+}
+
+// Bring the precache in line with the manifest: fetch entries whose revision changed
+// (or that were evicted), drop entries that left the manifest, keep everything else.
+async function sync(manifest, warm) {
+    const cache = await caches.open(PRECACHE);
+    const stored = await cache.match(REVISIONS);
+    const revisions = stored ? await stored.json() : {};
+    const known = {};
+    const stale = [];
+    for (const [group, entries] of Object.entries(manifest.entries)) {
+        for (const [path, revision] of entries) {
+            const url = new URL(path, self.registration.scope).href;
+            known[url] = revision;
+            if (group !== 'pages' && !warm) continue;
+            if (revisions[url] !== revision || !(await cache.match(url))) stale.push(url);
+        }
+    }
+    for (const request of await cache.keys()) {
+        if (request.url !== REVISIONS && !(request.url in known)) {
+            await cache.delete(request);
+            delete revisions[request.url];
         }
+    }
+    let next = 0;
+    async function worker() {
+        while (next < stale.length) {
+            const url = stale[next++];
+            try {
+                const response = await fetch(url, {cache: 'no-cache'});
+                if (response.ok) {
+                    await cache.put(url, response);
+                    revisions[url] = known[url];
+                }
+            } catch (error) {
+                // Offline or quota exceeded: the entry is retried on the next sync
+            }
+        }
+    }
+    await Promise.all(Array.from({length: %(concurrency)d}, worker));
+    await cache.put(REVISIONS, new Response(JSON.stringify(revisions)));
+}
+
+async function trim(cache) {
+    const keys = await cache.keys();
+    for (const request of keys.slice(0, Math.max(0, keys.length - %(runtime_entries)d))) {
+        await cache.delete(request);
+    }
+}
+
+async function remember(request, response) {
+    const precache = await caches.open(PRECACHE);
+    if (await precache.match(request)) {
+        await precache.put(request, response);
+    } else {
+        const runtime = await caches.open(RUNTIME);
+        await runtime.put(request, response);
+        await trim(runtime);
+    }
+}
+
+// JSON keeps its query string, which carries versions such as the search index's
+function cacheKey(url) {
+    if (url.pathname.endsWith('.json')) return url.href.split('#')[0];
+    return url.origin + (url.pathname.endsWith('/') ? url.pathname + 'index.html' : url.pathname);
+}
+
+// Pages and JSON: answer from the cache at once and refresh it in the background
+async function staleWhileRevalidate(event, key) {
+    const cached = await caches.match(key);
+    const network = fetch(event.request).then(response => {
+        if (response.ok && !response.redirected) {
+            event.waitUntil(remember(key, response.clone()));
+        }
+        return response;
+    });
+    if (cached) {
+        event.waitUntil(network.catch(() => null));
+        return cached;
+    }
+    return network;
+}
 
-        for photo in data.get('photos', []):
-            album['photos'].append({
-                'uri': photo.get('uri'),
-                'description': decode_facebook_text(photo.get('description', '')),
-                'timestamp': photo.get('creation_timestamp', 0)
-            })
+// Content-hashed files never change under the same URL
+async function cacheFirst(event, key) {
+    const cached = await caches.match(key);
+    if (cached) return cached;
+    const response = await fetch(event.request);
+    if (response.status === 200) {
+        event.waitUntil(remember(key, response.clone()));
+    }
+    return response;
+}
+
+self.addEventListener('install', event => {
+    event.waitUntil(loadManifest().then(manifest => sync(manifest, false)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys()
+        .then(names => Promise.all(names.filter(name => name !== PRECACHE && name !== RUNTIME)
+            .map(name => caches.delete(name))))
+        .then(() => self.clients.claim()));
+});
+
+// Pages ask for the media part of the precache once they have loaded
+self.addEventListener('message', event => {
+    if (event.data === 'warm') {
+        event.waitUntil(loadManifest().then(manifest => sync(manifest, true)));
+    }
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || request.headers.has('range') || !request.url.startsWith(self.registration.scope)) {
+        return;
+    }
+    const key = cacheKey(url);
+    if (IMMUTABLE.test(url.pathname)) {
+        event.respondWith(cacheFirst(event, key));
+    } else if (request.mode === 'navigate' || /(\\.html|\\.json|\\/)$/.test(url.pathname)) {
+        event.respondWith(staleWhileRevalidate(event, key));
+    }
+});
+"""
+
+# Served in place of the worker by the --watch preview, so cached pages never hide a rebuild
+SERVICE_WORKER_DISABLED_SCRIPT = """self.addEventListener('install', () => self.skipWaiting());
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys().then(names => Promise.all(names.map(name => caches.delete(name))))
+        .then(() => self.registration.unregister()));
+});
+"""
+
+SERVICE_WORKER_REGISTRATION = f'''<script>
+    if ('serviceWorker' in navigator) {{
+        addEventListener('load', function () {{
+            navigator.serviceWorker.register('{SERVICE_WORKER}');
+            if (!(navigator.connection && navigator.connection.saveData)) {{
+                navigator.serviceWorker.ready.then(function (registration) {{ registration.active.postMessage('warm'); }});
+            }}
+        }});
+    }}
+    </script>'''
+
+def build_precache_manifest(pages):
+    """The precache manifest for a build's pages, stylesheet and thumbnails.
+
+    Page revisions are their input hashes from the build manifest, so a
+    rebuild changes exactly the revisions of the pages it rewrote. The
+    stylesheet and thumbnails carry their content hash in the filename and
+    need no revision. Only the smallest thumbnail of each image is listed,
+    in the format pages offer first; larger widths go to the runtime cache
+    as they are viewed.
+    """
+    entries = {'pages': [], 'thumbnails': []}
+    for name, key in sorted(pages.items()):
+        if name.endswith('.html'):
+            entries['pages'].append([name, key[:HASHED_NAME_LENGTH]])
+    if STYLESHEET['href']:
+        entries['pages'].append([STYLESHEET['href'], None])
+    thumbs = set()
+    for info in THUMBNAILS.values():
+        if info['widths']:
+            ext = '.webp' if info['webp'] else '.jpg'
+            thumbs.add(f"media/thumbs/{thumbnail_name(info['hash'], info['widths'][0], ext)}")
+    entries['thumbnails'] = [[name, None] for name in sorted(thumbs)]
+    return {'version': hash_inputs(entries)[:HASHED_NAME_LENGTH], 'entries': entries}
+
+def write_service_worker(scheduler, pages, media_layout):
+    """Write the precache manifest and the service worker that installs it.
+
+    On install the worker precaches every page and the stylesheet; once a
+    page has loaded it also precaches the smallest thumbnails, unless the
+    visitor asked to save data. Later builds change the manifest version
+    baked into sw.js, so browsers pick up the new worker, which refetches
+    only the entries whose revision changed. At runtime, content-hashed
+    files are served cache-first (full-size media only with the hashed
+    media layout) and pages and JSON stale-while-revalidate.
+    """
+    manifest = build_precache_manifest(pages)
+    content = json.dumps(manifest, separators=(',', ':'))
+    script = SERVICE_WORKER_SCRIPT % {
+        'version': manifest['version'], 'manifest': PRECACHE_MANIFEST,
+        'immutable': SERVICE_WORKER_IMMUTABLE[media_layout],
+        'concurrency': PRECACHE_CONCURRENCY, 'runtime_entries': RUNTIME_CACHE_ENTRIES,
+    }
+    scheduler.add(PRECACHE_MANIFEST, hash_bytes(content), render_text, content)
+    scheduler.add(SERVICE_WORKER, hash_bytes(script), render_text, script)
+    print(f"Precache manifest: {len(manifest['entries']['pages'])} pages, "
+          f"{len(manifest['entries']['thumbnails'])} thumbnails")
+
+class OpenGraphParser(HTMLParser):
+    """Collect Open Graph (and fallback) metadata from a page's <head>"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.title = ''
+        self.in_title = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if tag == 'meta':
+            key = (attrs.get('property') or attrs.get('name') or '').lower()
+            if key and attrs.get('content') and key not in self.meta:
+                self.meta[key] = attrs['content'].strip()
+        elif tag == 'title':
+            self.in_title = True
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title and not self.done:
+            self.title += data
+
+def parse_open_graph(page, base_url):
+    """Extract a link preview from a page's HTML, or None if it has no title"""
+    parser = OpenGraphParser()
+    try:
+        parser.feed(page)
+    except Exception:
+        pass
+    meta = parser.meta
+    title = meta.get('og:title') or meta.get('twitter:title') or parser.title.strip()
+    if not title:
+        return None
+    image = meta.get('og:image') or meta.get('og:image:url') or meta.get('twitter:image')
+    return {
+        'title': ' '.join(title.split()),
+        'description': meta.get('og:description') or meta.get('description') or '',
+        'image': urljoin(base_url, image) if image else None,
+        'site_name': meta.get('og:site_name') or urlsplit(base_url).hostname or '',
+        'url': urljoin(base_url, meta['og:url']) if meta.get('og:url') else base_url,
+    }
+
+def http_get(url, max_bytes, timeout=PREVIEW_TIMEOUT):
+    """Blocking GET returning (final URL, content type, charset, body up to max_bytes)"""
+    request = urllib.request.Request(url, headers={
+        'User-Agent': PREVIEW_USER_AGENT,
+        'Accept': 'text/html,application/xhtml+xml,image/*;q=0.9,*/*;q=0.8',
+    })
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return (response.geturl(), response.headers.get_content_type(),
+                response.headers.get_content_charset(), response.read(max_bytes))
+
+def preview_image_name(image_url):
+    """Output filename for a preview image, keyed by the image URL"""
+    return f"preview_{hashlib.md5(image_url.encode('utf-8')).hexdigest()[:12]}.jpg"
+
+def save_preview_image(data, target):
+    """Resize a downloaded preview image to PREVIEW_IMAGE_WIDTH and save it as JPEG"""
+    tmp = target.with_name(f".{target.name}.tmp")
+    if Image is None:
+        tmp.write_bytes(data)
+    else:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            if img.width > PREVIEW_IMAGE_WIDTH:
+                img = img.resize((PREVIEW_IMAGE_WIDTH, max(1, round(img.height * PREVIEW_IMAGE_WIDTH / img.width))),
+                                 Image.LANCZOS)
+            img.save(tmp, 'JPEG', quality=82, optimize=True, progressive=True)
+    os.replace(tmp, target)
 
-        if data.get('cover_photo'):
-            album['cover'] = data['cover_photo'].get('uri')
-        elif album['photos']:
-            album['cover'] = album['photos'][0]['uri']
+async def fetch_link_preview(url, connections, host_limits):
+    """Fetch one page's Open Graph metadata and its preview image.
 
-        if album['photos']:
-            albums.append(album)
+    ``connections`` bounds concurrent requests overall and ``host_limits``
+    per host; the blocking I/O runs in worker threads. Returns a cache
+    entry, with an ``error`` key on failure.
+    """
+    def limit(target):
+        host = urlsplit(target).hostname or ''
+        if host not in host_limits:
+            host_limits[host] = asyncio.Semaphore(PREVIEW_MAX_PER_HOST)
+        return host_limits[host]
 
-    return albums
+    now = int(time.time())
+    try:
+        async with limit(url), connections:
+            final_url, content_type, charset, body = await asyncio.to_thread(
+                http_get, url, PREVIEW_MAX_PAGE_BYTES)
+        if content_type not in ('text/html', 'application/xhtml+xml'):
+            return {'error': f"not HTML ({content_type})", 'fetched_at': now}
+        preview = parse_open_graph(body.decode(charset or 'utf-8', errors='replace'), final_url)
+        if preview is None:
+            return {'error': "no title or Open Graph metadata", 'fetched_at': now}
+
+        preview['local_image'] = None
+        if preview['image']:
+            name = preview_image_name(preview['image'])
+            target = MEDIA_OUTPUT / name
+            if not target.exists():
+                try:
+                    async with limit(preview['image']), connections:
+                        _, image_type, _, data = await asyncio.to_thread(
+                            http_get, preview['image'], PREVIEW_MAX_IMAGE_BYTES)
+                    if image_type.startswith('image/'):
+                        await asyncio.to_thread(save_preview_image, data, target)
+                except Exception as e:
+                    print(f"Error fetching preview image for {url}: {e}")
+            if target.exists():
+                preview['local_image'] = f"media/{name}"
+        preview['fetched_at'] = now
+        return preview
+    except Exception as e:
+        return {'error': str(e) or type(e).__name__, 'fetched_at': now}
+
+def preview_is_fresh(entry, now):
+    """True if a cached preview (or cached failure) is still within its TTL.
+
+    Entries without ``fetched_at`` were added by hand and never expire.
+    """
+    if 'fetched_at' not in entry:
+        return True
+    ttl = PREVIEW_ERROR_TTL if 'error' in entry else PREVIEW_TTL
+    return now - entry['fetched_at'] < ttl
+
+async def _fetch_link_previews(urls):
+    connections = asyncio.Semaphore(PREVIEW_MAX_CONNECTIONS)
+    host_limits = {}
+    results = await asyncio.gather(*(fetch_link_preview(url, connections, host_limits) for url in urls))
+    return dict(zip(urls, results))
+
+def resolve_link_previews(posts, offline=False):
+    """Fill LINK_PREVIEWS for every post['external_url'] from the cache, fetching what's stale.
+
+    Results, including failures, are persisted to link_previews.json so
+    later builds (and --offline builds) don't touch the network. Expired
+    entries are refetched; with ``offline`` the cache is used as-is.
+    Returns when the first of the previews used expires, or None.
+    """
+    cache = load_json(PREVIEWS_FILE) if PREVIEWS_FILE.exists() else None
+    cache = cache or {}
+    urls = list(dict.fromkeys(p['external_url'] for p in posts if p['external_url']))
+    now = int(time.time())
+    stale = [url for url in urls if url not in cache or not preview_is_fresh(cache[url], now)]
+    REPORT.count('cache.previews.hits', len(urls) - len(stale))
+    REPORT.count('cache.previews.misses', len(stale))
+
+    if stale and not offline:
+        start = time.perf_counter()
+        fetched = asyncio.run(_fetch_link_previews(stale))
+        failed = sum(1 for entry in fetched.values() if 'error' in entry)
+        REPORT.count('previews.fetched', len(fetched) - failed)
+        REPORT.count('previews.failed', failed)
+        for url, entry in fetched.items():
+            # Keep a stale preview rather than replacing it with a transient failure
+            if 'error' not in entry or 'error' in cache.get(url, {'error': True}):
+                cache[url] = entry
+            else:
+                cache[url]['fetched_at'] = entry['fetched_at']
+        tmp = PREVIEWS_FILE.with_name(PREVIEWS_FILE.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, PREVIEWS_FILE)
+        print(f"Fetched {len(stale)} link previews ({failed} failed) in {time.perf_counter() - start:.2f}s")
+    elif stale:
+        print(f"Offline: {len(stale)} link previews missing or stale in the cache")
+
+    LINK_PREVIEWS.clear()
+    for url in urls:
+        entry = cache.get(url)
+        if entry and 'error' not in entry:
+            LINK_PREVIEWS[url] = entry
+            if entry.get('local_image'):
+                name = entry['local_image'][len("media/"):]
+                if name not in DIMENSIONS and (MEDIA_OUTPUT / name).exists():
+                    size = _read_dimensions(MEDIA_OUTPUT / name)
+                    if size:
+                        DIMENSIONS[name] = tuple(size)
+    print(f"{len(LINK_PREVIEWS)} of {len(urls)} links have previews")
+    expiries = [cache[url]['fetched_at'] + (PREVIEW_ERROR_TTL if 'error' in cache[url] else PREVIEW_TTL)
+                for url in urls if url in cache and 'fetched_at' in cache[url]]
+    return min(expiries, default=None)
+
+def _replace_if_changed(tmp, path):
+    """Move tmp over path unless path already has the same bytes, keeping its mtime for crawlers"""
+    if path.exists() and path.stat().st_size == tmp.stat().st_size and hash_file(path) == hash_file(tmp):
+        tmp.unlink()
+        return False
+    os.replace(tmp, path)
+    return True
+
+def w3c_datetime(ts):
+    """Format a Unix timestamp for <lastmod>"""
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+def write_sitemaps(directory, name, base_url, urls):
+    """Stream (path, lastmod) pairs into {name}-N.xml sitemap files.
+
+    A new file is started every SITEMAP_MAX_URLS URLs (or before one would
+    pass SITEMAP_MAX_BYTES), so memory stays flat however many URLs there
+    are. Files whose bytes didn't change are left alone, and files left
+    over from a longer previous run are deleted. Returns
+    [(filename, lastmod)] for the sitemap index, lastmod being the newest
+    in each file.
+    """
+    directory = Path(directory)
+    header = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    footer = '</urlset>\n'
+    written = []
+    f = None
+    count = used = 0
+
+    def finish():
+        f.write(footer)
+        f.close()
+        _replace_if_changed(Path(f.name), directory / written[-1][0])
+
+    for path, lastmod in urls:
+        entry = f"<url><loc>{xml_escape(base_url + path)}</loc>"
+        entry += f"<lastmod>{lastmod}</lastmod></url>\n" if lastmod else "</url>\n"
+        size = len(entry.encode('utf-8'))
+        if f is None or count >= SITEMAP_MAX_URLS or used + size + len(footer) > SITEMAP_MAX_BYTES:
+            if f is not None:
+                finish()
+            filename = f"{name}-{len(written) + 1}.xml"
+            written.append([filename, None])
+            f = open(directory / (filename + '.tmp'), 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+            f.write(header)
+            count, used = 0, len(header)
+        f.write(entry)
+        count += 1
+        used += size
+        if lastmod and (written[-1][1] is None or lastmod > written[-1][1]):
+            written[-1][1] = lastmod
+    if f is not None:
+        finish()
+
+    keep = {filename for filename, _ in written}
+    for stale in directory.glob(f"{name}-*.xml"):
+        if stale.name not in keep:
+            stale.unlink()
+    return [tuple(entry) for entry in written]
+
+def write_sitemap_index(path, sitemaps):
+    """Write a sitemap index listing (url, lastmod) sitemap files"""
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for url, lastmod in sitemaps:
+            f.write(f"<sitemap><loc>{xml_escape(url)}</loc>"
+                    + (f"<lastmod>{lastmod}</lastmod>" if lastmod else "") + "</sitemap>\n")
+        f.write('</sitemapindex>\n')
+    _replace_if_changed(tmp, path)
+
+def archive_sitemap_urls(names):
+    """(path, lastmod) for generated pages; unchanged pages keep their mtime, so lastmod is when they last changed"""
+    for name in names:
+        path = '' if name == 'index.html' else name
+        yield path, w3c_datetime((OUTPUT_DIR / name).stat().st_mtime)
+
+CANONICAL_PATTERN = re.compile(r'''<link\b[^>]*\brel=["']canonical["'][^>]*\bhref=["']([^"']*)["']''', re.IGNORECASE)
+PUBLISHED_PATTERN = re.compile(r'''<time\b[^>]*\bclass=["']published["'][^>]*\bdatetime=["']([^"']+)["']''', re.IGNORECASE)
+
+def mirror_sitemap_urls(site_root):
+    """(path, lastmod) for every page of the static WordPress mirror under site_root.
+
+    Pages are the index.html files outside the archive; their canonical
+    link is used as the path when present, and the post date as lastmod.
+    """
+    site_root = Path(site_root).resolve()
+    archive = OUTPUT_DIR.resolve()
+    seen = set()
+    for dirpath, dirs, files in os.walk(site_root):
+        here = Path(dirpath)
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in SITEMAP_SKIP_DIRS
+                         and here / d != archive)
+        if 'index.html' not in files:
+            continue
+        with open(here / 'index.html', encoding='utf-8', errors='replace') as f:
+            page = f.read()
+        match = CANONICAL_PATTERN.search(page)
+        rel = here.relative_to(site_root).as_posix()
+        path = urlsplit(match.group(1)).path if match else ('/' if rel == '.' else f"/{rel}/")
+        if path in seen:
+            continue
+        seen.add(path)
+        published = PUBLISHED_PATTERN.search(page)
+        yield path.lstrip('/'), published.group(1) if published else None
+
+def write_site_sitemaps(pages, site_root=None):
+    """Write the archive's sitemap.xml index, and a site-wide one in site_root if given.
+
+    Permalinks go in their own files, oldest first, so new posts only
+    touch the last file; the listing pages, which shift with every new
+    post, are kept apart from them.
+    """
+    listings = sorted(name for name in pages
+                      if name.endswith('.html') and not name.startswith('post-'))
+    permalinks = sorted(name for name in pages if name.startswith('post-'))
+    sitemaps = (write_sitemaps(OUTPUT_DIR, "sitemap-pages", ARCHIVE_URL, archive_sitemap_urls(listings))
+                + write_sitemaps(OUTPUT_DIR, "sitemap-posts", ARCHIVE_URL, archive_sitemap_urls(permalinks)))
+    archive_index = [(ARCHIVE_URL + filename, lastmod) for filename, lastmod in sitemaps]
+    write_sitemap_index(OUTPUT_DIR / "sitemap.xml", archive_index)
+    print(f"Wrote {len(listings) + len(permalinks)} archive URLs in {len(sitemaps)} sitemaps")
+
+    if site_root:
+        site_root = Path(site_root)
+        mirror = write_sitemaps(site_root, "sitemap-site", f"{SITE_URL}/", mirror_sitemap_urls(site_root))
+        write_sitemap_index(site_root / "sitemap.xml",
+                            [(f"{SITE_URL}/{filename}", lastmod) for filename, lastmod in mirror] + archive_index)
+        print(f"Wrote the site-wide sitemap index to {site_root / 'sitemap.xml'}")
 
 def generate_css():
     """Generate Facebook-inspired CSS"""
@@ -339,6 +3065,11 @@ main {
 .post-meta .date {
     font-size: 13px;
     color: var(--text-secondary);
+    text-decoration: none;
+}
+
+.post-meta a.date:hover {
+    text-decoration: underline;
 }
 
 .post-content {
@@ -365,9 +3096,33 @@ main {
 
 .post-media img {
     width: 100%;
+    height: auto;
     display: block;
 }
 
+.post-video {
+    position: relative;
+}
+
+.post-media video {
+    width: 100%;
+    height: auto;
+    display: block;
+    background: #000;
+}
+
+.video-duration {
+    position: absolute;
+    top: 8px;
+    right: 8px;
+    padding: 2px 6px;
+    border-radius: 4px;
+    background: rgba(0, 0, 0, 0.7);
+    color: white;
+    font-size: 12px;
+    pointer-events: none;
+}
+
 .post-link {
     margin: 0 16px 12px;
     padding: 12px;
@@ -387,6 +3142,157 @@ main {
     text-decoration: underline;
 }
 
+/* Link Preview Styles */
+.link-preview {
+    display: block;
+    border: 1px solid var(--border-color);
+    border-radius: 0;
+    overflow: hidden;
+    text-decoration: none;
+    color: inherit;
+    background: var(--bg-primary);
+}
+
+.link-preview:hover {
+    background: #e4e6e9;
+}
+
+.link-preview-image {
+    width: 100%;
+    height: 280px;
+    object-fit: cover;
+    border-bottom: 1px solid var(--border-color);
+}
+
+.link-preview-content {
+    padding: 12px 16px;
+}
+
+.link-preview-site {
+    font-size: 12px;
+    color: var(--text-secondary);
+    text-transform: uppercase;
+    margin-bottom: 4px;
+}
+
+.link-preview-title {
+    font-size: 16px;
+    font-weight: 600;
+    color: var(--text-primary);
+    margin-bottom: 4px;
+    display: -webkit-box;
+    -webkit-line-clamp: 2;
+    -webkit-box-orient: vertical;
+    overflow: hidden;
+}
+
+.link-preview-description {
+    font-size: 14px;
+    color: var(--text-secondary);
+    display: -webkit-box;
+    -webkit-line-clamp: 2;
+    -webkit-box-orient: vertical;
+    overflow: hidden;
+}
+
+/* Pagination */
+.pagination {
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+    margin: 20px 0;
+    color: var(--text-secondary);
+    font-size: 14px;
+}
+
+.pagination a {
+    color: var(--fb-blue);
+    font-weight: 600;
+    text-decoration: none;
+}
+
+.pagination a:hover {
+    text-decoration: underline;
+}
+
+/* Archive listing */
+.archive-list {
+    list-style: none;
+}
+
+.archive-list > li {
+    background: var(--bg-card);
+    border-radius: 8px;
+    margin-bottom: 16px;
+    padding: 16px 20px;
+    box-shadow: var(--shadow);
+}
+
+.archive-list h3 a {
+    color: var(--text-primary);
+    text-decoration: none;
+}
+
+.archive-months {
+    list-style: none;
+    display: flex;
+    flex-wrap: wrap;
+    gap: 8px 16px;
+    margin-top: 8px;
+    font-size: 14px;
+}
+
+.archive-months a {
+    color: var(--fb-blue);
+    text-decoration: none;
+}
+
+.archive-months span {
+    color: var(--text-secondary);
+}
+
+/* Search */
+.search-form {
+    display: flex;
+    gap: 8px;
+    margin-top: 12px;
+}
+
+.search-form input {
+    flex: 1;
+    padding: 10px 12px;
+    font-size: 15px;
+    border: 1px solid var(--border-color);
+    border-radius: 6px;
+}
+
+.search-status {
+    color: var(--text-secondary);
+    margin-bottom: 12px;
+    font-size: 14px;
+}
+
+.search-result {
+    display: block;
+    background: var(--bg-card);
+    border-radius: 8px;
+    margin-bottom: 12px;
+    padding: 12px 16px;
+    box-shadow: var(--shadow);
+    color: inherit;
+    text-decoration: none;
+}
+
+.search-result h3 {
+    font-size: 15px;
+    color: var(--fb-blue);
+}
+
+.search-result .date {
+    font-size: 13px;
+    color: var(--text-secondary);
+}
+
 /* Albums page */
 .albums-grid {
     display: grid;
@@ -450,6 +3356,7 @@ main {
 }
 
 .photo-item {
+    display: block;
     position: relative;
     aspect-ratio: 1;
     overflow: hidden;
@@ -499,16 +3406,42 @@ main {
     max-width: 600px;
 }
 
-.lightbox-close {
+.lightbox-close {
+    position: absolute;
+    top: 20px;
+    right: 20px;
+    color: white;
+    font-size: 30px;
+    cursor: pointer;
+    background: none;
+    border: none;
+    padding: 10px;
+}
+
+.lightbox-nav {
     position: absolute;
-    top: 20px;
-    right: 20px;
+    top: 50%;
+    transform: translateY(-50%);
     color: white;
-    font-size: 30px;
+    font-size: 48px;
+    line-height: 1;
     cursor: pointer;
     background: none;
     border: none;
-    padding: 10px;
+    padding: 20px;
+}
+
+.lightbox-prev {
+    left: 10px;
+}
+
+.lightbox-next {
+    right: 10px;
+}
+
+.lightbox-counter {
+    color: #b0b3b8;
+    font-size: 13px;
 }
 
 /* Footer */
@@ -557,6 +3490,73 @@ footer a {
 }
 '''
 
+def minify_css(css):
+    """Strip comments and redundant whitespace from a stylesheet"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+def split_css_rules(css):
+    """Split minified CSS into top-level rules ('selector{...}' or '@media ...{...}')"""
+    rules = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(css):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append(css[start:i + 1])
+                start = i + 1
+    return rules
+
+def is_critical_rule(rule):
+    """True if every selector of a rule is in CRITICAL_SELECTORS"""
+    selectors = rule[:rule.index('{')].split(',')
+    return all(sel.startswith(CRITICAL_SELECTORS) and ':hover' not in sel for sel in selectors)
+
+def extract_critical_css(css):
+    """Keep only the above-the-fold rules of a minified stylesheet"""
+    critical = []
+    for rule in split_css_rules(css):
+        if rule.startswith('@media'):
+            brace = rule.index('{')
+            inner = [r for r in split_css_rules(rule[brace + 1:-1]) if is_critical_rule(r)]
+            if inner:
+                critical.append(rule[:brace + 1] + ''.join(inner) + '}')
+        elif is_critical_rule(rule):
+            critical.append(rule)
+    return ''.join(critical)
+
+def write_stylesheet(scheduler, critical=False):
+    """Write the minified stylesheet as style.<hash>.css and point every page at it.
+
+    The content hash in the filename lets the file be cached forever; a CSS
+    change produces a new name and the old file is removed as an orphan.
+    """
+    css = minify_css(generate_css())
+    digest = hash_bytes(css)
+    name = f"style.{digest[:12]}.css"
+    scheduler.add(name, digest, render_text, css)
+    STYLESHEET['href'] = name
+    STYLESHEET['critical'] = extract_critical_css(css) if critical else None
+
+def generate_stylesheet_html():
+    """Generate the <head> stylesheet tags for a page"""
+    href = STYLESHEET['href']
+    if not href:
+        # Pages rendered outside main() keep the CSS inline
+        return f'<style>{generate_css()}</style>'
+    if not STYLESHEET['critical']:
+        return f'<link rel="stylesheet" href="{href}">'
+    # Inline the critical rules and load the rest without blocking render
+    return (f'<style>{STYLESHEET["critical"]}</style>\n'
+            f'    <link rel="preload" href="{href}" as="style" onload="this.onload=null;this.rel=\'stylesheet\'">\n'
+            f'    <noscript><link rel="stylesheet" href="{href}"></noscript>')
+
 def generate_header(active_page="posts"):
     """Generate page header HTML"""
     return f'''
@@ -573,18 +3573,21 @@ def generate_header(active_page="posts"):
         <ul>
             <li><a href="/facebook/" class="{'active' if active_page == 'posts' else ''}">Posts</a></li>
             <li><a href="/facebook/photos.html" class="{'active' if active_page == 'photos' else ''}">Photos</a></li>
+            <li><a href="/facebook/archives.html" class="{'active' if active_page == 'archive' else ''}">Archive</a></li>
+            <li><a href="/facebook/search.html" class="{'active' if active_page == 'search' else ''}">Search</a></li>
             <li><a href="/facebook/about.html" class="{'active' if active_page == 'about' else ''}">About</a></li>
         </ul>
     </nav>
 '''
 
 def generate_footer():
-    """Generate page footer HTML"""
-    return '''
+    """Generate page footer HTML, with the service worker registration"""
+    return f'''
     <footer>
         <p>This archive was created from a Facebook data export.</p>
         <p>Original content &copy; Deemable Tech. Archive generated January 2026.</p>
     </footer>
+    {SERVICE_WORKER_REGISTRATION}
 '''
 
 def generate_post_html(post, profile_pic_path):
@@ -592,15 +3595,36 @@ def generate_post_html(post, profile_pic_path):
     media_html = ""
     for m in post['media']:
         media_path = get_media_path(m['uri'])
-        if media_path:
+        if media_path and media_path.lower().endswith(VIDEO_EXTENSIONS):
+            media_html += f'''
+            <div class="post-media post-video">
+                {generate_video_html(media_path, m['description'])}
+            </div>
+            '''
+        elif media_path:
             media_html += f'''
             <div class="post-media">
-                <img src="{media_path}" alt="{html.escape(m['description'])}" loading="lazy">
+                {generate_img_html(media_path, html.escape(m['description']), sizes=SIZES_POST_MEDIA)}
             </div>
             '''
 
     link_html = ""
-    if post['external_url']:
+    preview = LINK_PREVIEWS.get(post['external_url'])
+    if preview:
+        image_html = ""
+        if preview.get('local_image'):
+            image_html = generate_img_html(preview['local_image'], "", "link-preview-image", SIZES_POST_MEDIA)
+        link_html = f'''
+    <a href="{html.escape(post['external_url'])}" class="link-preview" target="_blank" rel="noopener">
+        {image_html}
+        <div class="link-preview-content">
+            <div class="link-preview-site">{html.escape(preview.get('site_name') or '')}</div>
+            <div class="link-preview-title">{html.escape(preview['title'])}</div>
+            <div class="link-preview-description">{html.escape(preview.get('description') or '')}</div>
+        </div>
+    </a>
+    '''
+    elif post['external_url']:
         link_html = f'''
         <div class="post-link">
             <a href="{html.escape(post['external_url'])}" target="_blank" rel="noopener">
@@ -613,13 +3637,19 @@ def generate_post_html(post, profile_pic_path):
     if post['text']:
         text_html = f'<p>{linkify(html.escape(post["text"]))}</p>'
 
+    date_html = format_timestamp(post['timestamp'])
+    if post.get('slug'):
+        date_html = f'<a href="{post_filename(post)}" class="date" rel="bookmark">{date_html}</a>'
+    else:
+        date_html = f'<span class="date">{date_html}</span>'
+
     return f'''
-    <article class="post">
+    <article class="post" id="post-{post['timestamp']}">
         <div class="post-header">
-            <img src="{profile_pic_path}" alt="Deemable Tech" class="post-avatar">
+            {generate_img_html(profile_pic_path, "Deemable Tech", "post-avatar", SIZES_AVATAR, loading=None)}
             <div class="post-meta">
                 <h3>Deemable Tech</h3>
-                <span class="date">{format_timestamp(post['timestamp'])}</span>
+                {date_html}
             </div>
         </div>
         <div class="post-content">
@@ -630,36 +3660,191 @@ def generate_post_html(post, profile_pic_path):
     </article>
     '''
 
-def generate_index_page(posts, albums, profile_pic_path, cover_photo_path):
-    """Generate main index page with posts"""
-    posts_html = ""
+def page_filename(prefix, page):
+    """Filename for page N of a paginated listing; page 1 has no suffix"""
+    if prefix == "index":
+        return "index.html" if page == 1 else f"page-{page}.html"
+    return f"{prefix}.html" if page == 1 else f"{prefix}-page-{page}.html"
+
+def paginate(items, per_page):
+    """Split items into pages of at most per_page items (always at least one page)"""
+    if per_page <= 0:
+        return [items]
+    return [items[i:i + per_page] for i in range(0, len(items), per_page)] or [[]]
+
+def group_posts_by_month(posts):
+    """Group posts into {year: {month: [posts]}}, preserving post order"""
+    years = {}
     for post in posts:
-        posts_html += generate_post_html(post, profile_pic_path)
+        if not post['timestamp']:
+            continue
+        dt = datetime.fromtimestamp(post['timestamp'])
+        years.setdefault(dt.year, {}).setdefault(dt.month, []).append(post)
+    return years
+
+def month_name(year, month):
+    """Human readable month label, e.g. 'May 2013'"""
+    return datetime(year, month, 1).strftime("%B %Y")
+
+def generate_pagination(prefix, page, total_pages, prev_label="Newer posts", next_label="Older posts"):
+    """Generate prev/next navigation for a paginated listing"""
+    if total_pages <= 1:
+        return ""
+    prev_html = f'<a href="{page_filename(prefix, page - 1)}" rel="prev">&larr; {prev_label}</a>' if page > 1 else '<span></span>'
+    next_html = f'<a href="{page_filename(prefix, page + 1)}" rel="next">{next_label} &rarr;</a>' if page < total_pages else '<span></span>'
+    return f'''
+        <div class="pagination">
+            {prev_html}
+            <span>Page {page} of {total_pages}</span>
+            {next_html}
+        </div>
+        '''
+
+def render_index_page(posts, albums, profile_pic_path, cover_photo_path, page=1, total_pages=1):
+    """Yield one page of the main post timeline, one fragment per post"""
+    cover_html = ""
+    if page == 1:
+        cover_html = f'''
+        <div class="cover-section">
+            {generate_img_html(cover_photo_path, "Cover photo", "cover-photo", SIZES_COVER_PHOTO, loading=None)}
+            <div class="profile-section">
+                {generate_img_html(profile_pic_path, "Deemable Tech", "profile-pic", SIZES_PROFILE_PIC, loading=None)}
+                <div class="profile-info">
+                    <h2>Deemable Tech</h2>
+                    <p>Tech Tips &amp; Podcast</p>
+                </div>
+            </div>
+        </div>
+        '''
+
+    title = "Deemable Tech - Facebook Archive"
+    if page > 1:
+        title = f"Page {page} - {title}"
+
+    yield f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title}</title>
+    {generate_stylesheet_html()}
+</head>
+<body>
+    {generate_header('posts')}
+
+    <main>
+        {cover_html}
+'''
+    for post in posts:
+        yield generate_post_html(post, profile_pic_path)
+    yield f'''
+        {generate_pagination("index", page, total_pages)}
+    </main>
+
+    {generate_footer()}
+</body>
+</html>
+'''
+
+def generate_index_page(posts, albums, profile_pic_path, cover_photo_path, page=1, total_pages=1):
+    """Generate one page of the main post timeline"""
+    return "".join(render_index_page(posts, albums, profile_pic_path, cover_photo_path, page, total_pages))
+
+def post_filename(post):
+    """Filename of a post's permalink page"""
+    return f"post-{post['slug']}.html"
+
+def post_heading(post):
+    """Short title for a post's permalink page"""
+    text = post['text'] or post['title'] or ' '.join(m['description'] for m in post['media'])
+    return snippet(text, 70) or f"Post from {format_date_short(post['timestamp'])}"
+
+def generate_post_page(post, profile_pic_path, newer=None, older=None):
+    """Generate the permalink page for one post.
+
+    ``newer`` and ``older`` are (filename, heading) pairs for the
+    neighbouring posts, or None at either end of the timeline.
+    """
+    heading = html.escape(post_heading(post))
+    description = html.escape(snippet(post['text'] or post['title']))
+    url = ARCHIVE_URL + post_filename(post)
+    image_html = ""
+    for m in post['media']:
+        media_path = get_media_path(m['uri'])
+        if media_path and not media_path.lower().endswith(VIDEO_EXTENSIONS):
+            image_html = f'\n    <meta property="og:image" content="{html.escape(ARCHIVE_URL + media_path)}">'
+            break
+
+    newer_html = (f'<a href="{newer[0]}" rel="prev">&larr; {html.escape(newer[1])}</a>'
+                  if newer else '<span></span>')
+    older_html = (f'<a href="{older[0]}" rel="next">{html.escape(older[1])} &rarr;</a>'
+                  if older else '<span></span>')
 
     return f'''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Deemable Tech - Facebook Archive</title>
-    <style>{generate_css()}</style>
+    <title>{heading} - Deemable Tech Facebook Archive</title>
+    <meta name="description" content="{description}">
+    <link rel="canonical" href="{url}">
+    <meta property="og:type" content="article">
+    <meta property="og:title" content="{heading}">
+    <meta property="og:description" content="{description}">
+    <meta property="og:url" content="{url}">{image_html}
+    {generate_stylesheet_html()}
 </head>
 <body>
     {generate_header('posts')}
 
     <main>
-        <div class="cover-section">
-            <img src="{cover_photo_path}" alt="Cover photo" class="cover-photo">
-            <div class="profile-section">
-                <img src="{profile_pic_path}" alt="Deemable Tech" class="profile-pic">
-                <div class="profile-info">
-                    <h2>Deemable Tech</h2>
-                    <p>Tech Tips &amp; Podcast</p>
-                </div>
-            </div>
+        {generate_post_html(post, profile_pic_path)}
+        <div class="pagination">
+            {newer_html}
+            {older_html}
         </div>
+    </main>
+
+    {generate_footer()}
+</body>
+</html>
+'''
+
+def render_archive_page(posts, heading, prefix, page, total_pages, profile_pic_path, months=None):
+    """Yield one page of a per-year or per-month post archive, one fragment per post"""
+    months_html = ""
+    if months:
+        items = "".join(
+            f'<li><a href="month-{year}-{month:02d}.html">{month_name(year, month)}</a> <span>({count})</span></li>'
+            for year, month, count in months
+        )
+        months_html = f'<ul class="archive-months">{items}</ul>'
+
+    title = html.escape(heading)
+    if page > 1:
+        title = f"{title}, page {page}"
+
+    yield f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title} - Deemable Tech Facebook Archive</title>
+    {generate_stylesheet_html()}
+</head>
+<body>
+    {generate_header('archive')}
 
-        {posts_html}
+    <main>
+        <div class="album-header">
+            <h2>{html.escape(heading)}</h2>
+            {months_html}
+        </div>
+'''
+    for post in posts:
+        yield generate_post_html(post, profile_pic_path)
+    yield f'''
+        {generate_pagination(prefix, page, total_pages)}
     </main>
 
     {generate_footer()}
@@ -667,28 +3852,61 @@ def generate_index_page(posts, albums, profile_pic_path, cover_photo_path):
 </html>
 '''
 
-def generate_photos_page(albums, profile_pic_path):
-    """Generate photos/albums listing page"""
-    albums_html = ""
-    for i, album in enumerate(albums):
-        cover_path = get_media_path(album['cover']) if album['cover'] else "media/placeholder.jpg"
-        albums_html += f'''
-        <a href="album-{i}.html" class="album-card">
-            <img src="{cover_path}" alt="{html.escape(album['name'])}" class="album-cover" loading="lazy">
-            <div class="album-info">
-                <h3>{html.escape(album['name'])}</h3>
-                <p>{len(album['photos'])} photos</p>
-            </div>
-        </a>
-        '''
+def generate_archive_page(posts, heading, prefix, page, total_pages, profile_pic_path, months=None):
+    """Generate one page of a per-year or per-month post archive"""
+    return "".join(render_archive_page(posts, heading, prefix, page, total_pages, profile_pic_path, months))
+
+def generate_archives_page(years):
+    """Generate the archive listing of every year and month with posts"""
+    years_html = ""
+    for year in sorted(years, reverse=True):
+        months = years[year]
+        count = sum(len(p) for p in months.values())
+        months_html = "".join(
+            f'<li><a href="month-{year}-{month:02d}.html">{datetime(year, month, 1).strftime("%B")}</a> <span>({len(months[month])})</span></li>'
+            for month in sorted(months, reverse=True)
+        )
+        years_html += f'''
+            <li>
+                <h3><a href="year-{year}.html">{year}</a> <span class="date">({count} posts)</span></h3>
+                <ul class="archive-months">{months_html}</ul>
+            </li>
+            '''
 
     return f'''<!DOCTYPE html>
 <html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Archive - Deemable Tech Facebook Archive</title>
+    {generate_stylesheet_html()}
+</head>
+<body>
+    {generate_header('archive')}
+
+    <main>
+        <div class="album-header">
+            <h2>Post Archive</h2>
+        </div>
+        <ul class="archive-list">
+            {years_html}
+        </ul>
+    </main>
+
+    {generate_footer()}
+</body>
+</html>
+'''
+
+def render_photos_page(albums, profile_pic_path):
+    """Yield the photos/albums listing page, one fragment per album"""
+    yield f'''<!DOCTYPE html>
+<html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Photos - Deemable Tech Facebook Archive</title>
-    <style>{generate_css()}</style>
+    {generate_stylesheet_html()}
 </head>
 <body>
     {generate_header('photos')}
@@ -698,7 +3916,19 @@ def generate_photos_page(albums, profile_pic_path):
             <h2>Photo Albums</h2>
         </div>
         <div class="albums-grid">
-            {albums_html}
+'''
+    for i, album in enumerate(albums):
+        cover_path = get_media_path(album['cover']) if album['cover'] else "media/placeholder.jpg"
+        yield f'''
+        <a href="album-{i}.html" class="album-card">
+            {generate_img_html(cover_path, html.escape(album['name']), "album-cover", SIZES_ALBUM_COVER)}
+            <div class="album-info">
+                <h3>{html.escape(album['name'])}</h3>
+                <p>{len(album['photos'])} photos</p>
+            </div>
+        </a>
+        '''
+    yield f'''
         </div>
     </main>
 
@@ -707,27 +3937,43 @@ def generate_photos_page(albums, profile_pic_path):
 </html>
 '''
 
-def generate_album_page(album, index, profile_pic_path):
-    """Generate individual album page"""
-    photos_html = ""
+def generate_photos_page(albums, profile_pic_path):
+    """Generate photos/albums listing page"""
+    return "".join(render_photos_page(albums, profile_pic_path))
+
+def album_photos(album):
+    """(photo, media path) for every photo in an album that has a file"""
+    photos = []
     for photo in album['photos']:
         photo_path = get_media_path(photo['uri'])
         if photo_path:
-            caption = html.escape(photo['description']) if photo['description'] else ''
-            escaped_caption = caption.replace("'", "\\'")
-            photos_html += f'''
-            <div class="photo-item" onclick="openLightbox('{photo_path}', '{escaped_caption}')">
-                <img src="{photo_path}" alt="{caption}" loading="lazy">
-            </div>
-            '''
+            photos.append((photo, photo_path))
+    return photos
 
-    return f'''<!DOCTYPE html>
+def generate_album_manifest(album):
+    """Compact JSON list of an album's [src, caption] pairs, read by the lightbox"""
+    photos = [[photo_path, photo['description'] or ''] for photo, photo_path in album_photos(album)]
+    return json.dumps({'photos': photos}, ensure_ascii=False, separators=(',', ':'))
+
+def render_album_page(album, index, profile_pic_path, page=1, per_page=ALBUM_PHOTOS_PER_PAGE):
+    """Yield one page of an album's photo grid, one fragment per photo.
+
+    The grid is paginated so huge albums stay small; the lightbox loads the
+    album's JSON manifest, so next/prev moves across the whole album.
+    """
+    pages = paginate(album_photos(album), per_page)
+    offset = (page - 1) * per_page if per_page > 0 else 0
+    title = html.escape(album['name'])
+    if page > 1:
+        title = f"Page {page} - {title}"
+
+    yield f'''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{html.escape(album['name'])} - Deemable Tech Facebook Archive</title>
-    <style>{generate_css()}</style>
+    <title>{title} - Deemable Tech Facebook Archive</title>
+    {generate_stylesheet_html()}
 </head>
 <body>
     {generate_header('photos')}
@@ -737,44 +3983,101 @@ def generate_album_page(album, index, profile_pic_path):
             <h2>{html.escape(album['name'])}</h2>
             <p>{len(album['photos'])} photos</p>
         </div>
-        <div class="photos-grid">
-            {photos_html}
+        <div class="photos-grid" id="photos-grid" data-manifest="{ALBUMS_DIR}/{index}.json">
+'''
+    for n, (photo, photo_path) in enumerate(pages[page - 1], offset):
+        caption = html.escape(photo['description']) if photo['description'] else ''
+        yield f'''
+            <a href="{photo_path}" class="photo-item" data-index="{n}">
+                {generate_img_html(photo_path, caption, sizes=SIZES_PHOTO_TILE)}
+            </a>
+            '''
+    yield f'''
         </div>
+        {generate_pagination(f"album-{index}", page, len(pages), "Previous photos", "More photos")}
     </main>
 
     <div class="lightbox" id="lightbox">
-        <button class="lightbox-close" onclick="closeLightbox()">&times;</button>
+        <button class="lightbox-close" id="lightbox-close" aria-label="Close">&times;</button>
+        <button class="lightbox-nav lightbox-prev" id="lightbox-prev" aria-label="Previous photo">&lsaquo;</button>
         <img src="" alt="" id="lightbox-img">
+        <button class="lightbox-nav lightbox-next" id="lightbox-next" aria-label="Next photo">&rsaquo;</button>
         <div class="lightbox-caption" id="lightbox-caption"></div>
+        <div class="lightbox-counter" id="lightbox-counter"></div>
     </div>
 
     {generate_footer()}
 
     <script>
-    function openLightbox(src, caption) {{
-        document.getElementById('lightbox-img').src = src;
-        document.getElementById('lightbox-caption').textContent = caption;
-        document.getElementById('lightbox').classList.add('active');
-        document.body.style.overflow = 'hidden';
-    }}
+    (function () {{
+        var grid = document.getElementById('photos-grid');
+        var box = document.getElementById('lightbox');
+        var img = document.getElementById('lightbox-img');
+        var caption = document.getElementById('lightbox-caption');
+        var counter = document.getElementById('lightbox-counter');
+        var photos = null, current = 0, preloaded = {{}};
 
-    function closeLightbox() {{
-        document.getElementById('lightbox').classList.remove('active');
-        document.body.style.overflow = '';
-    }}
+        // Until the manifest arrives, clicking a photo simply opens the image
+        fetch(grid.dataset.manifest)
+            .then(function (response) {{ return response.json(); }})
+            .then(function (data) {{ photos = data.photos; }});
 
-    document.getElementById('lightbox').addEventListener('click', function(e) {{
-        if (e.target === this) closeLightbox();
-    }});
+        function prefetch(i) {{
+            i = (i + photos.length) % photos.length;
+            if (preloaded[i]) return;
+            preloaded[i] = new Image();
+            preloaded[i].src = photos[i][0];
+        }}
 
-    document.addEventListener('keydown', function(e) {{
-        if (e.key === 'Escape') closeLightbox();
-    }});
+        function show(i) {{
+            current = (i + photos.length) % photos.length;
+            img.src = photos[current][0];
+            img.alt = photos[current][1];
+            caption.textContent = photos[current][1];
+            counter.textContent = (current + 1) + ' / ' + photos.length;
+            for (var d = 1; d <= {LIGHTBOX_PREFETCH}; d++) {{
+                prefetch(current + d);
+                prefetch(current - d);
+            }}
+        }}
+
+        function close() {{
+            box.classList.remove('active');
+            document.body.style.overflow = '';
+        }}
+
+        grid.addEventListener('click', function (e) {{
+            var item = e.target.closest('.photo-item');
+            if (!item || !photos) return;
+            e.preventDefault();
+            show(Number(item.dataset.index));
+            box.classList.add('active');
+            document.body.style.overflow = 'hidden';
+        }});
+
+        document.getElementById('lightbox-close').addEventListener('click', close);
+        document.getElementById('lightbox-prev').addEventListener('click', function () {{ show(current - 1); }});
+        document.getElementById('lightbox-next').addEventListener('click', function () {{ show(current + 1); }});
+        box.addEventListener('click', function (e) {{
+            if (e.target === box) close();
+        }});
+
+        document.addEventListener('keydown', function (e) {{
+            if (!box.classList.contains('active')) return;
+            if (e.key === 'Escape') close();
+            else if (e.key === 'ArrowLeft') show(current - 1);
+            else if (e.key === 'ArrowRight') show(current + 1);
+        }});
+    }})();
     </script>
 </body>
 </html>
 '''
 
+def generate_album_page(album, index, profile_pic_path, page=1, per_page=ALBUM_PHOTOS_PER_PAGE):
+    """Generate one page of an individual album"""
+    return "".join(render_album_page(album, index, profile_pic_path, page, per_page))
+
 def generate_about_page(profile_pic_path):
     """Generate about page"""
     return f'''<!DOCTYPE html>
@@ -783,7 +4086,7 @@ def generate_about_page(profile_pic_path):
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>About - Deemable Tech Facebook Archive</title>
-    <style>{generate_css()}</style>
+    {generate_stylesheet_html()}
 </head>
 <body>
     {generate_header('about')}
@@ -791,7 +4094,7 @@ def generate_about_page(profile_pic_path):
     <main>
         <article class="post">
             <div class="post-header">
-                <img src="{profile_pic_path}" alt="Deemable Tech" class="post-avatar">
+                {generate_img_html(profile_pic_path, "Deemable Tech", "post-avatar", SIZES_AVATAR, loading=None)}
                 <div class="post-meta">
                     <h3>About This Archive</h3>
                 </div>
@@ -810,21 +4113,459 @@ def generate_about_page(profile_pic_path):
 </html>
 '''
 
-def main():
-    print("Building Deemable Tech Facebook Archive...")
+def generate_search_page():
+    """Generate the client-side search page"""
+    return f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Search - Deemable Tech Facebook Archive</title>
+    {generate_stylesheet_html()}
+</head>
+<body>
+    {generate_header('search')}
+
+    <main>
+        <div class="album-header">
+            <h2>Search the Archive</h2>
+            <form class="search-form" id="search-form">
+                <input type="search" id="search-input" placeholder="Search posts and photo captions" autofocus>
+            </form>
+        </div>
+        <div class="search-status" id="search-status"></div>
+        <div id="search-results"></div>
+    </main>
+
+    {generate_footer()}
+
+    <script>
+    const STOPWORDS = new Set({json.dumps(sorted(SEARCH_STOPWORDS))});
+    const cache = {{}};
+    const PER_PAGE = 20;
+
+    function fetchJSON(url) {{
+        if (!cache[url]) cache[url] = fetch(url + '?v={SEARCH_INDEX_VERSION}').then(r => r.ok ? r.json() : {{}});
+        return cache[url];
+    }}
+
+    function tokenize(text) {{
+        const folded = text.toLowerCase().normalize('NFKD').replace(/\\p{{M}}/gu, '');
+        return (folded.match(/[\\p{{L}}\\p{{N}}_]+/gu) || [])
+            .filter(t => [...t].length >= 2 && !STOPWORDS.has(t) && !/^[0-9]+$/.test(t));
+    }}
+
+    function decode(deltas) {{
+        let id = 0;
+        return deltas.map(d => (id += d));
+    }}
+
+    async function lookup(term, prefixMatch) {{
+        const index = await fetchJSON('search/shards.json');
+        let best = '';
+        for (const prefix in index.shards) {{
+            if (term.startsWith(prefix) && prefix.length > best.length) best = prefix;
+        }}
+        // A split shard keeps only its short terms, so a prefix search also reads its children
+        const names = best ? [best] : [];
+        if (prefixMatch) {{
+            for (const prefix in index.shards) {{
+                if (prefix.length > term.length && prefix.startsWith(term)) names.push(prefix);
+            }}
+        }}
+        const shards = await Promise.all(names.map(name => fetchJSON('search/' + index.shards[name])));
+        const ids = new Set();
+        for (const shard of shards) {{
+            for (const t in shard) {{
+                if (t === term || (prefixMatch && t.startsWith(term))) decode(shard[t]).forEach(id => ids.add(id));
+            }}
+        }}
+        return ids;
+    }}
+
+    function escapeHTML(text) {{
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }}
+
+    async function search(query) {{
+        const status = document.getElementById('search-status');
+        const results = document.getElementById('search-results');
+        const terms = tokenize(query);
+        results.innerHTML = '';
+        if (!terms.length) {{
+            status.textContent = '';
+            return;
+        }}
+        // Every term must match; the last one may still be being typed
+        const sets = await Promise.all(terms.map((t, i) => lookup(t, i === terms.length - 1)));
+        let ids = [...sets[0]].filter(id => sets.every(set => set.has(id)));
+        ids.sort((a, b) => a - b);
+        status.textContent = ids.length + (ids.length === 1 ? ' result' : ' results');
+        const index = await fetchJSON('search/shards.json');
+        const shown = ids.slice(0, PER_PAGE);
+        const chunks = await Promise.all(shown.map(id => fetchJSON('search/docs-' + Math.floor(id / index.chunk) + '.json')));
+        results.innerHTML = shown.map((id, i) => {{
+            const [url, title, text, date] = chunks[i][id % index.chunk];
+            return '<a class="search-result" href="' + escapeHTML(url) + '">' +
+                '<h3>' + escapeHTML(title) + '</h3>' +
+                '<span class="date">' + escapeHTML(date) + '</span>' +
+                '<p>' + escapeHTML(text) + '</p></a>';
+        }}).join('');
+    }}
+
+    const input = document.getElementById('search-input');
+    let timer;
+    input.addEventListener('input', () => {{
+        clearTimeout(timer);
+        timer = setTimeout(() => {{
+            history.replaceState(null, '', '?q=' + encodeURIComponent(input.value));
+            search(input.value);
+        }}, 150);
+    }});
+    document.getElementById('search-form').addEventListener('submit', e => e.preventDefault());
+    const initial = new URLSearchParams(location.search).get('q');
+    if (initial) {{
+        input.value = initial;
+        search(initial);
+    }}
+    </script>
+</body>
+</html>
+'''
+
+LIVE_RELOAD_SCRIPT = f'''<script>
+(function () {{
+    // Injected by the --watch preview server only
+    var source = new EventSource('{LIVE_RELOAD_PATH}'), lost = false;
+    var page = decodeURIComponent(location.pathname.split('/').pop()) || 'index.html';
+    source.onerror = function () {{ lost = true; }};
+    source.onopen = function () {{ if (lost) location.reload(); }};
+    source.onmessage = function (event) {{
+        var changed = JSON.parse(event.data);
+        if (changed.some(function (name) {{ return name === '*' || name === page || /\\.css$/.test(name); }})) {{
+            location.reload();
+        }}
+    }};
+}})();
+</script>
+'''
+
+def scan_files(paths):
+    """Map every file under paths (files or directories) to its (size, mtime_ns)"""
+    found = {}
+    stack = [Path(p) for p in paths]
+    while stack:
+        path = stack.pop()
+        try:
+            if path.is_dir():
+                with os.scandir(path) as entries:
+                    stack.extend(Path(entry.path) for entry in entries)
+            else:
+                st = path.stat()
+                found[path] = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return found
+
+def watch_paths():
+    """Everything a build reads: the export, the link preview cache and the builder itself"""
+    export = [Path(path) for path in EXPORT_ZIPS] or [ARCHIVE_DIR]
+    return export + [PREVIEWS_FILE, Path(__file__).resolve()]
+
+def build_inputs(args):
+    """Key for everything a build reads and every option that shapes its output, from file stats alone"""
+    files = sorted((path.as_posix(), stat) for path, stat in scan_files(watch_paths()).items())
+    options = [args.media_layout, args.link_mode, args.thumbnails, args.dedupe, args.dedupe_distance,
+               args.critical_css, args.posts_per_page, args.sitemap_root]
+    return hash_inputs(builder_fingerprint(), options, files)
+
+def site_is_current(manifest, inputs, offline=False):
+    """True if the last build read exactly these inputs, no preview it used has expired and its outputs exist"""
+    if manifest.get('inputs') != inputs:
+        return False
+    fresh_until = manifest.get('fresh_until')
+    if not offline and fresh_until is not None and time.time() >= fresh_until:
+        return False
+    outputs = list(manifest['pages']) + ["sitemap.xml"]
+    outputs += [f"{MEDIA_OUTPUT.relative_to(OUTPUT_DIR).as_posix()}/{entry['output']}"
+                for entry in manifest['media'].values() if 'duplicate_of' not in entry and 'output' in entry]
+    # One listing per directory is far cheaper than a stat per output
+    listings = {}
+    for name in outputs:
+        directory, _, filename = name.rpartition('/')
+        if directory not in listings:
+            try:
+                listings[directory] = set(os.listdir(OUTPUT_DIR / directory))
+            except OSError:
+                return False
+        if filename not in listings[directory]:
+            return False
+    return True
+
+class LiveReload:
+    """Hands the pages written by each rebuild to connected preview tabs"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.changed = []
+
+    def publish(self, names):
+        with self.condition:
+            self.generation += 1
+            self.changed = list(names)
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Block until a build newer than generation; returns (generation, names or None on timeout)"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            if self.generation == generation:
+                return generation, None
+            return self.generation, self.changed
+
+def make_preview_handler(live_reload):
+    class PreviewHandler(SimpleHTTPRequestHandler):
+        """Serves OUTPUT_DIR with the live-reload script injected into HTML pages"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(OUTPUT_DIR), **kwargs)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if path == LIVE_RELOAD_PATH:
+                return self.stream_reloads()
+            if path.endswith('/' + SERVICE_WORKER):
+                return self.send_script(SERVICE_WORKER_DISABLED_SCRIPT)
+            target = Path(self.translate_path(self.path))
+            if target.is_dir():
+                target = target / "index.html"
+            if target.suffix == '.html' and target.is_file():
+                return self.send_page(target)
+            return super().do_GET()
+
+        def send_page(self, target):
+            body = target.read_bytes()
+            at = body.rfind(b'</body>')
+            script = LIVE_RELOAD_SCRIPT.encode('utf-8')
+            body = body[:at] + script + body[at:] if at >= 0 else body + script
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_script(self, script):
+            body = script.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/javascript; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def stream_reloads(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            generation = live_reload.generation
+            try:
+                self.wfile.write(b"retry: 500\n\n")
+                self.wfile.flush()
+                while True:
+                    generation, changed = live_reload.wait(generation, 15)
+                    message = ": ping\n\n" if changed is None else f"data: {json.dumps(changed)}\n\n"
+                    self.wfile.write(message.encode('utf-8'))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def end_headers(self):
+            self.send_header('Cache-Control', 'no-cache')
+            super().end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return PreviewHandler
+
+def serve_preview(host, port, live_reload):
+    """Start the preview server on a background thread"""
+    server = ThreadingHTTPServer((host, port), make_preview_handler(live_reload))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"\nPreviewing at http://{host}:{server.server_address[1]}/ (live reload)")
+    return server
+
+def watch(args):
+    """Rebuild whenever the export, the preview cache or the builder changes.
 
-    # Copy media files
-    print("\nCopying media files...")
-    copy_media_files()
+    Media stages run only when posts/media (or an export ZIP) changed; a
+    change to this script restarts the process.
+    """
+    live_reload = LiveReload()
+    if args.preview_port:
+        serve_preview(args.preview_host, args.preview_port, live_reload)
+    builder = Path(__file__).resolve()
+    media_dir = ARCHIVE_DIR / "posts" / "media"
+    state = scan_files(watch_paths())
+    print(f"Watching {', '.join(EXPORT_ZIPS) or ARCHIVE_DIR} for changes (Ctrl+C to stop)...")
+
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            current = scan_files(watch_paths())
+            if current == state:
+                continue
+            # Let multi-step saves finish before reading anything
+            time.sleep(WATCH_SETTLE)
+            current = scan_files(watch_paths())
+            changed = sorted({path for path in state.keys() | current.keys()
+                              if state.get(path) != current.get(path)})
+            state = current
+
+            if builder in changed:
+                print("\nBuilder changed, restarting...")
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+
+            start = time.perf_counter()
+            media = any(media_dir in path.parents or str(path) in EXPORT_ZIPS for path in changed)
+            print(f"\nChanged: {', '.join(str(path) for path in changed)}")
+            try:
+                with build_lock():
+                    written = build(args, media=media)
+            except Exception:
+                # Pages are staged, so a failed build leaves the preview as it was
+                traceback.print_exc()
+                continue
+            live_reload.publish(written + (['*'] if media else []))
+            print(f"Rebuilt {', '.join(written) or 'nothing'} in {time.perf_counter() - start:.2f}s")
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the static Deemable Tech Facebook archive")
+    parser.add_argument('--force', action='store_true',
+                        help="ignore the build manifest and export snapshot and rewrite every output")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="worker processes for loading and rendering (default: CPU count)")
+    parser.add_argument('--copy-workers', type=int, default=16,
+                        help="threads used to hash and copy media (default: 16)")
+    parser.add_argument('--link-mode', choices=('auto', 'reflink', 'hardlink', 'copy'), default='auto',
+                        help="how media is placed in the output: auto prefers reflinks, then hardlinks, "
+                             "then in-kernel copies (default: auto)")
+    parser.add_argument('--media-layout', choices=('flat', 'hashed'), default='flat',
+                        help="flat keeps export filenames; hashed stores each distinct file once under "
+                             "its content hash, safe to serve with Cache-Control: immutable (default: flat)")
+    parser.add_argument('--no-thumbnails', dest='thumbnails', action='store_false',
+                        default=Image is not None,
+                        help="skip resized derivatives and srcset (always skipped without Pillow)")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="serve one canonical file per cluster of near-duplicate photos (needs Pillow); "
+                             "check the printed matches, as graphics that share a template and differ "
+                             "only in small text can be merged")
+    parser.add_argument('--dedupe-distance', type=int, default=DEDUPE_DISTANCE, metavar='BITS',
+                        help=f"dHash bits two photos may differ by and still count as the same "
+                             f"(default: {DEDUPE_DISTANCE})")
+    parser.add_argument('--critical-css', action='store_true',
+                        help="inline above-the-fold CSS and load the stylesheet asynchronously")
+    parser.add_argument('--check-search', action='store_true',
+                        help="check that the search page's tokenizer matches the index's (needs node), then exit")
+    parser.add_argument('--optimize-images', action='store_true',
+                        help="losslessly strip metadata from copied JPEGs and PNGs (the export is untouched)")
+    parser.add_argument('--optimize-root', action='append', default=[], metavar='DIR',
+                        help="also optimize the images of another tree in place, e.g. .. for the WordPress "
+                             "mirror (repeatable)")
+    parser.add_argument('--precompress', action='store_true',
+                        help="write .gz/.br siblings of generated HTML/CSS/JS/JSON for static hosting")
+    parser.add_argument('--no-precompress', action='store_true',
+                        help="delete the .gz/.br siblings written by an earlier --precompress build; "
+                             "otherwise they are kept up to date on every build")
+    parser.add_argument('--precompress-root', action='append', default=[], metavar='DIR',
+                        help="also precompress another tree, e.g. .. for the WordPress mirror (repeatable)")
+    parser.add_argument('--sitemap-root', metavar='DIR',
+                        help="also write a site-wide sitemap.xml index in DIR covering the WordPress mirror, "
+                             "e.g. .. (the archive's own sitemap.xml is always written)")
+    parser.add_argument('--export-zip', nargs='+', default=[], metavar='ZIP',
+                        help="read the export straight from these .zip parts instead of an unpacked "
+                             f"{ARCHIVE_DIR}")
+    parser.add_argument('--offline', action='store_true',
+                        help="build link previews from link_previews.json only, without fetching")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"profile the build with cProfile and tracemalloc; hot spots go in the build "
+                             f"report and raw stats in {PROFILE_FILE.name} (main process only, so use "
+                             f"--jobs 1 to include parsing and rendering)")
+    parser.add_argument('--watch', action='store_true',
+                        help="after building, rebuild the affected pages whenever the export changes")
+    parser.add_argument('--preview-port', type=int, default=8000,
+                        help="port for the live-reloading preview server in --watch mode, 0 to disable "
+                             "(default: 8000)")
+    parser.add_argument('--preview-host', default='127.0.0.1',
+                        help="address the preview server binds to (default: 127.0.0.1)")
+    parser.add_argument('--posts-per-page', type=int, default=POSTS_PER_PAGE,
+                        help=f"posts per timeline/archive page, 0 for a single page (default: {POSTS_PER_PAGE})")
+    return parser.parse_args(argv)
+
+def build_site(args, manifest, media=True, inputs=None):
+    """Copy media, load the export and render the pages whose inputs changed.
+
+    Returns the build's totals and the names of the pages it wrote.
+    """
+    new_manifest = empty_manifest()
+
+    if media:
+        # Copy media files
+        print("\nCopying media files...")
+        with REPORT.phase('copy'):
+            new_manifest['media'] = copy_media_files(manifest['media'], args.copy_workers, args.link_mode,
+                                                     args.media_layout)
+            remove_orphans(media_outputs(manifest['media']), media_outputs(new_manifest['media']), MEDIA_OUTPUT)
+
+        print("\nIndexing image dimensions...")
+        with REPORT.phase('dimensions'):
+            new_manifest['dimensions'] = index_image_dimensions(new_manifest['media'], manifest['dimensions'],
+                                                                args.copy_workers)
+
+        with REPORT.phase('dedupe'):
+            if args.dedupe:
+                print("\nFinding near-duplicate photos...")
+                new_manifest['fingerprints'] = dedupe_images(new_manifest['media'], new_manifest['dimensions'],
+                                                             manifest['fingerprints'], args.jobs, args.link_mode,
+                                                             args.dedupe_distance)
+            else:
+                _restore_media(new_manifest['media'], [key for key, entry in new_manifest['media'].items()
+                                                       if 'duplicate_of' in entry], args.link_mode)
+
+        with REPORT.phase('thumbnails'):
+            if args.thumbnails:
+                print("\nGenerating thumbnails...")
+                new_manifest['thumbs'] = generate_thumbnails(new_manifest['media'], manifest['thumbs'], args.jobs)
+            elif manifest['thumbs'] and THUMBS_OUTPUT.exists():
+                shutil.rmtree(THUMBS_OUTPUT)
+
+        print("\nPreparing videos...")
+        with REPORT.phase('videos'):
+            new_manifest['videos'] = prepare_videos(new_manifest['media'], manifest['videos'], args.jobs)
+    else:
+        for section in ('media', 'dimensions', 'thumbs', 'videos', 'fingerprints'):
+            new_manifest[section] = manifest[section]
 
     # Load data
-    print("\nLoading posts...")
-    posts = load_posts()
-    print(f"Found {len(posts)} posts")
+    with REPORT.phase('load'):
+        snapshot = {'version': SNAPSHOT_VERSION, 'files': {}, 'dirty': True} if args.force else load_snapshot()
 
-    print("\nLoading albums...")
-    albums = load_albums()
-    print(f"Found {len(albums)} albums")
+        print("\nLoading posts...")
+        posts = load_posts(args.jobs, snapshot)
+        print(f"Found {len(posts)} posts")
+
+        print("\nLoading albums...")
+        albums = load_albums(args.jobs, snapshot)
+        print(f"Found {len(albums)} albums")
+
+        save_snapshot(snapshot)
 
     # Find profile pic and cover photo
     profile_pic_path = "media/186683038016677.jpg"  # Default profile pic
@@ -845,28 +4586,182 @@ def main():
     print(f"\nUsing profile pic: {profile_pic_path}")
     print(f"Using cover photo: {cover_photo_path}")
 
-    # Generate pages
-    print("\nGenerating index page...")
-    with open(OUTPUT_DIR / "index.html", 'w', encoding='utf-8') as f:
-        f.write(generate_index_page(posts, albums, profile_pic_path, cover_photo_path))
+    print("\nResolving link previews...")
+    with REPORT.phase('previews'):
+        fresh_until = resolve_link_previews(posts, offline=args.offline)
 
-    print("Generating photos page...")
-    with open(OUTPUT_DIR / "photos.html", 'w', encoding='utf-8') as f:
-        f.write(generate_photos_page(albums, profile_pic_path))
+    # Generate pages, skipping any whose inputs match the last build
+    with REPORT.phase('plan'):
+        # Media only enters the keys of the pages that show it, via page_media_inputs()
+        shared = builder_fingerprint()
+        old_pages, new_pages = manifest['pages'], new_manifest['pages']
+        scheduler = RenderScheduler(old_pages, new_pages)
+        write_stylesheet(scheduler, args.critical_css)
+        shared = hash_inputs(shared, STYLESHEET)
+        chrome = page_media_inputs(paths=[profile_pic_path, cover_photo_path])
+        # Serialize each post's inputs once; listing pages hash the keys of the posts they show
+        post_keys = {post['slug']: hash_inputs(post, page_media_inputs([post])) for post in posts}
 
-    print("Generating album pages...")
-    for i, album in enumerate(albums):
-        with open(OUTPUT_DIR / f"album-{i}.html", 'w', encoding='utf-8') as f:
-            f.write(generate_album_page(album, i, profile_pic_path))
+        print("\nPlanning timeline pages...")
+        pages = paginate(posts, args.posts_per_page)
+        for page, page_posts in enumerate(pages, 1):
+            # The timeline template doesn't use albums, so don't ship them to every worker
+            scheduler.add(
+                page_filename("index", page),
+                hash_inputs(shared, [post_keys[p['slug']] for p in page_posts], page, len(pages), chrome),
+                render_index_page, page_posts, [], profile_pic_path, cover_photo_path, page, len(pages))
+
+        print("Planning archive pages...")
+        years = group_posts_by_month(posts)
+        scheduler.add(
+            "archives.html",
+            hash_inputs(shared, {year: {month: len(p) for month, p in months.items()} for year, months in years.items()}),
+            generate_archives_page, years)
+        for year, months in years.items():
+            year_posts = [post for month in sorted(months, reverse=True) for post in months[month]]
+            month_counts = [(year, month, len(months[month])) for month in sorted(months, reverse=True)]
+            archives = [(f"year-{year}", str(year), year_posts, month_counts)]
+            archives += [(f"month-{year}-{month:02d}", month_name(year, month), months[month], None)
+                         for month in months]
+            for prefix, heading, archive_posts, month_list in archives:
+                archive_pages = paginate(archive_posts, args.posts_per_page)
+                for page, page_posts in enumerate(archive_pages, 1):
+                    scheduler.add(
+                        page_filename(prefix, page),
+                        hash_inputs(shared, [post_keys[p['slug']] for p in page_posts], heading, page,
+                                    len(archive_pages), chrome, month_list),
+                        render_archive_page, page_posts, heading, prefix, page, len(archive_pages),
+                        profile_pic_path, month_list)
 
-    print("Generating about page...")
-    with open(OUTPUT_DIR / "about.html", 'w', encoding='utf-8') as f:
-        f.write(generate_about_page(profile_pic_path))
+        print("Planning post permalinks...")
+        for i, post in enumerate(posts):
+            newer = (post_filename(posts[i - 1]), post_heading(posts[i - 1])) if i > 0 else None
+            older = (post_filename(posts[i + 1]), post_heading(posts[i + 1])) if i + 1 < len(posts) else None
+            scheduler.add(
+                post_filename(post), hash_inputs(shared, post_keys[post['slug']], chrome, newer, older),
+                generate_post_page, post, profile_pic_path, newer, older)
+
+        print("Planning photos page...")
+        album_summaries = [(a['name'], a['cover'], len(a['photos'])) for a in albums]
+        scheduler.add(
+            "photos.html",
+            hash_inputs(shared, album_summaries, chrome,
+                        page_media_inputs(paths=[get_media_path(a['cover']) for a in albums if a['cover']])),
+            render_photos_page, albums, profile_pic_path)
+
+        print("Planning album pages...")
+        for i, album in enumerate(albums):
+            manifest_json = generate_album_manifest(album)
+            scheduler.add(f"{ALBUMS_DIR}/{i}.json", hash_bytes(manifest_json), render_text, manifest_json)
+            album_pages = paginate(album_photos(album), ALBUM_PHOTOS_PER_PAGE)
+            for page, page_photos in enumerate(album_pages, 1):
+                photo_media = page_media_inputs(paths=[path for _, path in page_photos])
+                scheduler.add(
+                    page_filename(f"album-{i}", page), hash_inputs(shared, album, i, chrome, page, photo_media),
+                    render_album_page, album, i, profile_pic_path, page)
+
+        print("Building search index...")
+        write_search_index(posts, albums, scheduler, hash_inputs(shared, list(post_keys.values()), albums))
+        scheduler.add("search.html", shared, generate_search_page)
+
+        scheduler.add("about.html", hash_inputs(shared, chrome), generate_about_page, profile_pic_path)
+
+        print("Planning service worker...")
+        write_service_worker(scheduler, new_pages, args.media_layout)
+
+    print(f"\nRendering {len(scheduler.jobs)} changed pages...")
+    scheduler.run(args.jobs)
+    totals = {'posts': len(posts), 'albums': len(albums), 'pages': len(new_pages)}
+    with REPORT.phase('write'):
+        remove_orphans(old_pages, new_pages, OUTPUT_DIR)
+        new_manifest.update(inputs=inputs, totals=totals, fresh_until=fresh_until)
+        save_manifest(new_manifest)
+
+    # Sitemap dates come from page mtimes, so they only move when pages were written or removed
+    if (scheduler.written or old_pages.keys() != new_pages.keys() or args.sitemap_root
+            or not (OUTPUT_DIR / "sitemap.xml").exists()):
+        print("\nWriting sitemaps...")
+        with REPORT.phase('sitemap'):
+            write_site_sitemaps(new_pages, args.sitemap_root)
+    return totals, scheduler.written
+
+
+def build(args, media=True):
+    """Run one build and return the names of the pages it wrote.
+
+    With ``media=False`` the media stages are skipped and the media index,
+    dimensions and thumbnails of the previous build in this process are
+    reused; watch mode does this when only JSON files changed.
+    """
+    global REPORT
+    REPORT = BuildReport()
+    profiler = start_profiling() if args.profile else None
+    print("Building Deemable Tech Facebook Archive...")
+
+    manifest = empty_manifest() if args.force else load_manifest()
+    # Watch mode needs the media globals that only a full pass fills in
+    inputs = None if args.watch else build_inputs(args)
+    if inputs and site_is_current(manifest, inputs, args.offline):
+        print("\nNothing changed since the last build (--force rebuilds everything)")
+        totals, written = manifest['totals'], []
+        if args.sitemap_root:
+            # The mirror under --sitemap-root isn't one of the build's inputs
+            with REPORT.phase('sitemap'):
+                write_site_sitemaps(manifest['pages'], args.sitemap_root)
+    else:
+        totals, written = build_site(args, manifest, media, inputs)
+
+    if args.optimize_images or args.optimize_root:
+        print("\nOptimizing images...")
+        with REPORT.phase('optimize'):
+            optimize_images(MEDIA_OUTPUT, args.jobs)
+            for root in args.optimize_root:
+                optimize_images(root, args.jobs)
+
+    if args.no_precompress:
+        remove_precompressed(OUTPUT_DIR)
+    elif args.precompress or args.precompress_root or (OUTPUT_DIR / PRECOMPRESS_MANIFEST).exists():
+        if args.precompress or args.precompress_root:
+            print("\nPrecompressing output...")
+        else:
+            # Siblings from an earlier --precompress build would otherwise go stale
+            print("\nRefreshing .gz/.br siblings from an earlier --precompress build "
+                  "(--no-precompress removes them)...")
+        with REPORT.phase('precompress'):
+            # The raw export lives inside the output directory and is never served
+            precompress_tree(OUTPUT_DIR, args.jobs, exclude=[ARCHIVE_DIR.parent, MEDIA_OUTPUT, REPORT_FILE])
+            for root in args.precompress_root:
+                precompress_tree(root, args.jobs)
+
+    report = REPORT.as_dict()
+    report['totals'] = totals
+    if profiler:
+        report['profile'] = stop_profiling(profiler)
+    save_report(report)
 
     print("\n✓ Archive built successfully!")
-    print(f"  - {len(posts)} posts")
-    print(f"  - {len(albums)} albums")
+    print(f"  - {totals['posts']} posts")
+    print(f"  - {totals['albums']} albums")
+    print(f"  - {len(written)} of {totals['pages']} pages written")
     print(f"  - Files written to: {OUTPUT_DIR.absolute()}")
+    print(f"\nBuild took {report['wall_seconds']:.2f}s (details in {REPORT_FILE}):")
+    REPORT.print_summary()
+    if profiler:
+        print(f"Profile written to {PROFILE_FILE}; hottest functions:")
+        for entry in report['profile']['hot_functions'][:10]:
+            print(f"  {entry['own_seconds']:8.3f}s  {entry['function']}")
+    return written
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.check_search:
+        sys.exit(0 if check_search_tokenizer() else 1)
+    EXPORT_ZIPS[:] = [str(Path(path)) for path in args.export_zip]
+    with build_lock():
+        build(args)
+    if args.watch:
+        args.force = False
+        watch(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Check links across the Deemable Tech static site
+Reports broken internal href/src references and orphaned media files
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+# The repository root is the site root: /facebook/ is served from facebook/
+SITE_ROOT = Path(__file__).resolve().parent.parent
+# Raw Facebook exports are build inputs, not served pages
+SKIP_DIRS = {'.git', '__pycache__', "this_profile's_activity_across_facebook"}
+
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.mp4', '.mp3', '.m4a', '.pdf')
+EXTERNAL_SCHEMES = ('mailto:', 'tel:', 'javascript:', 'data:', 'about:', 'sms:', 'skype:', 'irc:')
+
+# Attribute values in markup, ignoring scripts and comments stripped beforehand
+ATTR_PATTERN = re.compile(
+    r'''\s(href|src|srcset|poster|data-src)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''',
+    re.IGNORECASE,
+)
+STRIP_PATTERN = re.compile(r'<script\b.*?</script\s*>|<!--.*?-->|<style\b.*?</style\s*>',
+                           re.IGNORECASE | re.DOTALL)
+CSS_URL_PATTERN = re.compile(r'''url\(\s*['"]?([^'")]+)['"]?\s*\)''', re.IGNORECASE)
+
+# Shared with pool workers through the initializer
+ROOT = SITE_ROOT
+FILES = set()
+DIRS = set()
+SITE_HOSTS = set()
+
+def build_index(root):
+    """Index every file and directory under root as root-relative POSIX paths"""
+    files = set()
+    dirs = {''}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        rel_dir = Path(dirpath).relative_to(root).as_posix()
+        rel_dir = '' if rel_dir == '.' else rel_dir
+        for d in dirnames:
+            dirs.add(f"{rel_dir}/{d}" if rel_dir else d)
+        for name in filenames:
+            files.add(f"{rel_dir}/{name}" if rel_dir else name)
+    return files, dirs
+
+def site_hosts(root):
+    """Hostnames that point back at this site, from CNAME"""
+    hosts = set()
+    cname = root / "CNAME"
+    if cname.exists():
+        host = cname.read_text(encoding='utf-8').strip().lower()
+        if host:
+            hosts.update({host, f"www.{host}"})
+    return hosts
+
+def _init_worker(root, files, dirs, hosts):
+    global ROOT, FILES, DIRS, SITE_HOSTS
+    ROOT, FILES, DIRS, SITE_HOSTS = root, files, dirs, hosts
+
+def extract_urls(text, is_css=False):
+    """Yield every URL referenced by an HTML or CSS document"""
+    if is_css:
+        for match in CSS_URL_PATTERN.finditer(text):
+            yield match.group(1).strip()
+        return
+    text = STRIP_PATTERN.sub('', text)
+    for match in ATTR_PATTERN.finditer(text):
+        attr = match.group(1).lower()
+        value = html.unescape(next(g for g in match.groups()[1:] if g is not None)).strip()
+        if attr == 'srcset':
+            for candidate in value.split(','):
+                url = candidate.strip().split(' ')[0]
+                if url:
+                    yield url
+        else:
+            yield value
+
+def resolve(url, source):
+    """Resolve a URL found in source to a root-relative path.
+
+    Returns None for external, empty or fragment-only URLs.
+    """
+    if not url or url.startswith('#') or url.lower().startswith(EXTERNAL_SCHEMES):
+        return None
+    parts = urlsplit(url)
+    if parts.scheme or parts.netloc:
+        if parts.scheme not in ('', 'http', 'https') or parts.netloc.lower() not in SITE_HOSTS:
+            return None
+    path = unquote(parts.path)
+    if not path:
+        return None
+    if path.startswith('/'):
+        target = path.lstrip('/')
+    else:
+        base = source.rsplit('/', 1)[0] if '/' in source else ''
+        target = f"{base}/{path}" if base else path
+
+    # Normalize . and .. segments
+    segments = []
+    for segment in target.split('/'):
+        if segment in ('', '.'):
+            continue
+        if segment == '..':
+            if segments:
+                segments.pop()
+            continue
+        segments.append(segment)
+    resolved = '/'.join(segments)
+    return resolved + '/' if (path.endswith('/') and resolved) else resolved
+
+def target_exists(target):
+    """True if a resolved path is a file, or a directory with an index file"""
+    stripped = target.rstrip('/')
+    if not target.endswith('/') and stripped in FILES:
+        return True
+    if stripped in DIRS:
+        prefix = f"{stripped}/index." if stripped else "index."
+        return any(f"{prefix}{ext}" in FILES for ext in ('html', 'htm', 'xml'))
+    return False
+
+def check_file(source):
+    """Check one document (runs in a worker process).
+
+    Returns (source, broken URLs, referenced files).
+    """
+    try:
+        text = (ROOT / source).read_text(encoding='utf-8', errors='replace')
+    except OSError as e:
+        return source, [f"<unreadable: {e}>"], []
+    broken = []
+    referenced = []
+    for url in extract_urls(text, source.endswith('.css')):
+        target = resolve(url, source)
+        if target is None:
+            continue
+        if target_exists(target):
+            referenced.append(target.rstrip('/'))
+        else:
+            broken.append(url)
+    return source, broken, referenced
+
+def check_site(root, workers=None, media_scope=None):
+    """Check every HTML and CSS file under root.
+
+    Returns (broken, orphans, stats): broken maps source files to their
+    broken URLs, orphans lists media files nothing references (limited to
+    paths under media_scope when given).
+    """
+    start = time.perf_counter()
+    files, dirs = build_index(root)
+    hosts = site_hosts(root)
+    documents = sorted(f for f in files if f.endswith(('.html', '.htm', '.css')))
+    index_time = time.perf_counter() - start
+
+    broken = {}
+    referenced = set()
+    with Pool(workers, initializer=_init_worker, initargs=(root, files, dirs, hosts)) as pool:
+        for source, bad, refs in pool.imap_unordered(check_file, documents, chunksize=16):
+            if bad:
+                broken[source] = bad
+            referenced.update(refs)
+
+    scopes = tuple(s.strip('/') + '/' for s in media_scope) if media_scope else ('',)
+    orphans = sorted(
+        f for f in files
+        if f.lower().endswith(MEDIA_EXTENSIONS) and f.startswith(scopes) and f not in referenced
+    )
+    stats = {
+        'files': len(files),
+        'documents': len(documents),
+        'broken_references': sum(len(v) for v in broken.values()),
+        'orphaned_media': len(orphans),
+        'index_seconds': round(index_time, 3),
+        'total_seconds': round(time.perf_counter() - start, 3),
+    }
+    return broken, orphans, stats
+
+def print_report(broken, orphans, stats, limit):
+    """Print a human-readable report, grouping broken URLs by target"""
+    by_url = {}
+    for source, urls in broken.items():
+        for url in urls:
+            by_url.setdefault(url, []).append(source)
+
+    if by_url:
+        print(f"Broken references ({stats['broken_references']} in {len(broken)} files):")
+        for url, sources in sorted(by_url.items(), key=lambda item: -len(item[1]))[:limit]:
+            print(f"  {url}  ({len(sources)} files, e.g. {sources[0]})")
+        if len(by_url) > limit:
+            print(f"  ... and {len(by_url) - limit} more targets")
+
+    if orphans:
+        print(f"\nOrphaned media ({len(orphans)} files):")
+        for path in orphans[:limit]:
+            print(f"  {path}")
+        if len(orphans) > limit:
+            print(f"  ... and {len(orphans) - limit} more")
+
+    print(f"\nChecked {stats['documents']} documents against {stats['files']} files "
+          f"in {stats['total_seconds']:.2f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Check internal links and media across the static site")
+    parser.add_argument('root', nargs='?', default=SITE_ROOT, type=Path,
+                        help="site root to check (default: the repository root)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument('--media-scope', action='append', metavar='DIR',
+                        help="only report orphaned media under DIR, e.g. facebook/media (repeatable)")
+    parser.add_argument('--limit', type=int, default=50, help="entries to print per section (default: 50)")
+    parser.add_argument('--json', action='store_true', help="print the full report as JSON")
+    args = parser.parse_args()
+
+    broken, orphans, stats = check_site(args.root.resolve(), args.jobs, args.media_scope)
+
+    if args.json:
+        json.dump({'stats': stats, 'broken': broken, 'orphaned_media': orphans}, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(broken, orphans, stats, args.limit)
+
+    return 1 if broken else 0
+
+if __name__ == "__main__":
+    sys.exit(main())